@@ -0,0 +1,326 @@
+import asyncio
+import collections
+import io
+import os
+import time
+import weakref
+
+import cassette
+import instrumentation
+import readiness
+import ssh_tool as ssh_tool_module
+from ssh_tool import (
+    bundle_key,
+    local_size,
+    ssh_tool,
+    write_bundle,
+)
+
+# Default cap on concurrent SSH sessions per event loop.
+MAX_SESSIONS = 32
+_SEMAPHORES = weakref.WeakKeyDictionary()
+# (event loop, master key) -> future of a master connection being started.
+_MASTER_STARTS = {}
+
+
+def get_semaphore(limit=MAX_SESSIONS):
+    """Return the session semaphore of the running event loop."""
+    loop = asyncio.get_event_loop()
+    if loop not in _SEMAPHORES:
+        _SEMAPHORES[loop] = asyncio.Semaphore(limit)
+    return _SEMAPHORES[loop]
+
+
+async def read_lines(stream, chunk_size=65536):
+    """Yield the lines of an asyncio stream as they arrive.
+
+    Lines longer than chunk_size are yielded in chunk_size pieces, so one
+    huge line never has to be held at once."""
+    pending = b""
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).splitlines(keepends=True)
+        pending = lines.pop()
+        if pending.endswith(b"\n") or len(pending) >= chunk_size:
+            lines.append(pending)
+            pending = b""
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+class async_ssh_tool(ssh_tool):
+    """Awaitable counterpart of ssh_tool built on asyncio subprocesses.
+
+    Every ssh/scp process is started while holding the session semaphore, so
+    hundreds of hosts can be driven from one thread without exceeding the
+    number of in-flight sessions. The coroutines carry an `a` prefix (assh,
+    aexecute, aput_bundle...), so the inherited ssh_tool methods keep working
+    for code that is handed this tool where an ssh_tool is expected."""
+
+    def __init__(
+        self, username, ip_address, sshkey=None, multiplex=True, semaphore=None
+    ):
+        ssh_tool.__init__(self, username, ip_address, sshkey, multiplex)
+        self._semaphore = semaphore
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = get_semaphore()
+        return self._semaphore
+
+    def _open_master(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Used through the inherited blocking methods.
+            return ssh_tool._open_master(self)
+        # Never block the event loop, the master is opened by `_async_open_master`.
+        return self._master_key in ssh_tool_module._CONTROL_MASTERS
+
+    async def _async_open_master(self):
+        key = self._master_key
+        if (
+            not self.multiplex
+            or self._open_master()
+            or key in ssh_tool_module._FAILED_MASTERS
+            or cassette.replaying()
+        ):
+            return
+        loop = asyncio.get_event_loop()
+        starting = _MASTER_STARTS.get((loop, key))
+        if starting is not None:
+            # Another task is already starting it, share its outcome.
+            await asyncio.shield(starting)
+            return
+        starting = _MASTER_STARTS[(loop, key)] = loop.create_future()
+        ok = False
+        try:
+            with instrumentation.span("ssh_master", host=self.ip) as span:
+                process = await asyncio.create_subprocess_exec(
+                    *self._master_call_list(),
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+                span.exit_code = await process.wait()
+            ok = span.exit_code == 0
+            self._master_started(ok)
+        finally:
+            # Waiters fall back to plain connections if we were cancelled.
+            del _MASTER_STARTS[(loop, key)]
+            starting.set_result(ok)
+
+    async def _run(
+        self,
+        call_list,
+        capture,
+        stdin=None,
+        operation="ssh",
+        detail=None,
+        key=None,
+        size=None,
+        keep_output=True,
+        log_file=None,
+        callback=None,
+    ):
+        """Run one ssh/scp process and return (exit code, output).
+
+        With capture, the combined output is streamed and its last TAIL_LINES
+        lines are kept in `output_tail`; without keep_output only that tail
+        is returned instead of the whole output. Every line is also passed
+        to callback and appended to log_file, when given."""
+        received = None
+        log = open(log_file, "ab") if log_file else None
+
+        def deliver(line):
+            if callback:
+                callback(line)
+            if log:
+                log.write(line)
+
+        async def run():
+            nonlocal received
+            async with self.semaphore:
+                await self._async_open_master()
+                # Rebuild the options now that the master connection may exist.
+                command = call_list()
+                print("async_ssh_tool: " + " ".join(command))
+                if stdin is not None:
+                    process = await asyncio.create_subprocess_exec(
+                        *command, stdin=asyncio.subprocess.PIPE
+                    )
+                    stdout = b""
+                    await process.communicate(stdin)
+                elif capture:
+                    process = await asyncio.create_subprocess_exec(
+                        *command,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.STDOUT,
+                    )
+                    self.output_tail = collections.deque(maxlen=self.TAIL_LINES)
+                    chunks = [] if keep_output else None
+                    received = 0
+                    async for line in read_lines(process.stdout):
+                        received += len(line)
+                        self.output_tail.append(line)
+                        if chunks is not None:
+                            chunks.append(line)
+                        deliver(line)
+                    await process.wait()
+                    stdout = b"".join(self.output_tail if chunks is None else chunks)
+                else:
+                    process = await asyncio.create_subprocess_exec(*command)
+                    stdout = b""
+                    await process.wait()
+            return process.returncode, stdout
+
+        with instrumentation.span(operation, host=self.ip, detail=detail) as span:
+            try:
+                returncode, stdout = await cassette.call_async(
+                    operation, self.ip, key or detail, run
+                )
+                if capture and cassette.replaying():
+                    for line in stdout.splitlines(keepends=True):
+                        deliver(line)
+            finally:
+                if log:
+                    log.close()
+            span.exit_code = returncode
+            if size is not None:
+                span.bytes = size()
+            elif stdin is not None:
+                span.bytes = len(stdin)
+            else:
+                span.bytes = len(stdout) if received is None else received
+        return returncode, stdout
+
+    async def aexecute(self, command, option=None):
+        return await self._run(
+            lambda: self._ssh_call_list(command, option), capture=True, detail=command
+        )
+
+    async def assh(
+        self,
+        command,
+        test=True,
+        option=None,
+        output=False,
+        silent=False,
+        log_file=None,
+        callback=None,
+    ):
+        """Awaitable ssh_tool.ssh.
+
+        output, silent, log_file and callback stream the output and keep only
+        a bounded tail of it for the error report."""
+        ret, stdout = await self._run(
+            lambda: self._ssh_call_list(command, option),
+            capture=bool(output or silent or log_file or callback),
+            detail=command,
+            keep_output=output,
+            log_file=log_file,
+            callback=callback,
+        )
+
+        if ret != 0:
+            print(f"async_ssh_tool: command failed with exit code {ret} on {self.ip}")
+            tail = stdout.splitlines(keepends=True)[-self.TAIL_LINES :]
+            print(b"".join(tail).decode(errors="replace"))
+
+        # By default, it is not ok to fail
+        if test:
+            assert ret == 0
+
+        if output:
+            return stdout
+        return ret
+
+    async def _tcp_reachable(self, port=22, timeout=3):
+        return await cassette.call_async(
+            "tcp", self.ip, str(port), lambda: self._tcp_connect(port, timeout)
+        )
+
+    async def _tcp_connect(self, port, timeout):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, port), timeout
+            )
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    async def acheck_access(self, deadline=readiness.DEADLINE):
+        """Awaitable ssh_tool.check_access."""
+        probe = readiness.Probe(self, time.monotonic() + deadline)
+        while True:
+            if probe.known_ready():
+                return True
+            if (
+                await self._tcp_reachable()
+                and await self.assh("uname -a", test=False, silent=True) == 0
+            ):
+                return probe.succeeded()
+            delay = probe.next_delay()
+            if delay is None:
+                return False
+            await cassette.sleep_async(delay)
+
+    async def aput_bundle(self, files, file_path_remote="", test=True, cache=None):
+        files, digests, command = self._upload_candidates(
+            files, file_path_remote, cache
+        )
+        remote_output = None
+        if command:
+            _, remote_output = await self.aexecute(command)
+        files = self._files_to_send(files, file_path_remote, digests, remote_output)
+        if not files:
+            return 0
+        # Scripts are small, pack in memory rather than feeding a pipe by hand.
+        bundle = io.BytesIO()
+        write_bundle(bundle, files)
+        ret, _ = await self._run(
+            lambda: self._bundle_call_list(file_path_remote),
+            capture=False,
+            stdin=bundle.getvalue(),
+            operation="bundle",
+            detail=files[0],
+            key=bundle_key(file_path_remote, files),
+        )
+        return self._bundle_sent(ret, file_path_remote, files, digests, test)
+
+    async def ascp_to(self, file_path_local, file_path_remote="", test=True):
+        ret, _ = await self._run(
+            lambda: self._scp_to_call_list(file_path_local, file_path_remote),
+            capture=False,
+            operation="scp_to",
+            detail=file_path_local,
+            size=lambda: (
+                local_size(file_path_local) if os.path.exists(file_path_local) else None
+            ),
+        )
+
+        # By default, it is not ok to fail
+        if test:
+            assert ret == 0
+
+        return ret
+
+    async def ascp_from(self, file_path_remote, file_path_local=".", test=True):
+        ret, _ = await self._run(
+            lambda: self._scp_from_call_list(file_path_remote, file_path_local),
+            capture=False,
+            operation="scp_from",
+            detail=file_path_remote,
+            size=lambda: self._downloaded_size(file_path_remote, file_path_local),
+        )
+
+        # By default, it is not ok to fail
+        if test:
+            assert ret == 0
+
+        return ret
@@ -0,0 +1,199 @@
+"""Record and replay MAAS and SSH interactions.
+
+With OSIAS_CASSETTE_MODE=record every MAAS command, SSH command, transfer and
+reachability probe is run as usual and appended, with its result and how long
+it took, to the JSON lines file OSIAS_CASSETTE. With OSIAS_CASSETTE_MODE=replay
+nothing touches the network: each call is answered from the cassette, in the
+order it was recorded for the same host and command, after the recorded delay
+divided by OSIAS_CASSETTE_SPEED (0 drops the delays). The same factor shortens
+the polling and retry sleeps of the orchestration code, so whole deploy.py
+operations can be benchmarked offline."""
+
+import asyncio
+import base64
+import collections
+import json
+import os
+import threading
+import time
+
+CASSETTE_VERSION = 1
+
+_mode = os.getenv("OSIAS_CASSETTE_MODE", "")
+_path = os.getenv("OSIAS_CASSETTE")
+_speed = float(os.getenv("OSIAS_CASSETTE_SPEED", "1"))
+_lock = threading.Lock()
+_recorded = None
+_started = time.monotonic()
+
+
+class Recorded_Failure(Exception):
+    """A call that raised while recording, raised again on replay."""
+
+
+def configure(mode, path=None, speed=1.0):
+    """Switch mode ("record", "replay" or "" for off) at runtime."""
+    global _mode, _path, _speed, _recorded
+    if mode and not path:
+        raise Exception("ERROR: A cassette file is needed to record or replay.")
+    with _lock:
+        _mode, _path, _speed, _recorded = mode, path, speed, None
+
+
+def recording():
+    return _mode == "record" and bool(_path)
+
+
+def replaying():
+    return _mode == "replay" and bool(_path)
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        try:
+            return {"text": value.decode("utf-8")}
+        except UnicodeDecodeError:
+            return {"bytes": base64.b64encode(value).decode()}
+    if isinstance(value, tuple):
+        return {"tuple": [_encode(v) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return {"dict": {k: _encode(v) for k, v in value.items()}}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        if "text" in value:
+            return value["text"].encode("utf-8")
+        if "bytes" in value:
+            return base64.b64decode(value["bytes"])
+        if "tuple" in value:
+            return tuple(_decode(v) for v in value["tuple"])
+        return {k: _decode(v) for k, v in value["dict"].items()}
+    return value
+
+
+def _key(kind, host, key):
+    return f"{kind}\0{host or ''}\0{key}"
+
+
+def record(kind, host, key, result=None, elapsed=0.0, error=None):
+    """Append one interaction to the cassette."""
+    entry = {
+        "kind": kind,
+        "host": host,
+        "key": key,
+        "at": round(time.monotonic() - _started, 3),
+        "elapsed": round(elapsed, 3),
+    }
+    if error is not None:
+        entry["error"] = str(error)
+    else:
+        entry["result"] = _encode(result)
+    with _lock:
+        new_file = not os.path.exists(_path) or os.path.getsize(_path) == 0
+        with open(_path, "a") as f:
+            if new_file:
+                f.write(json.dumps({"osias_cassette_version": CASSETTE_VERSION}) + "\n")
+            f.write(json.dumps(entry) + "\n")
+
+
+def _load():
+    global _recorded
+    recorded = collections.defaultdict(collections.deque)
+    with open(_path, "r") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("osias_cassette_version") != CASSETTE_VERSION:
+            raise Exception(
+                f"ERROR: {_path} is not a version {CASSETTE_VERSION} cassette."
+            )
+        for line in f:
+            entry = json.loads(line)
+            recorded[_key(entry["kind"], entry["host"], entry["key"])].append(entry)
+    _recorded = recorded
+
+
+def _next(kind, host, key):
+    with _lock:
+        if _recorded is None:
+            _load()
+        entries = _recorded.get(_key(kind, host, key))
+        if not entries:
+            raise Exception(
+                f"ERROR: No more recorded {kind} calls for {host or 'MAAS'}: {key}"
+            )
+        return entries.popleft()
+
+
+def _result(entry):
+    if "error" in entry:
+        raise Recorded_Failure(entry["error"])
+    return _decode(entry["result"])
+
+
+def replay(kind, host, key):
+    """Recorded result of the next matching call, after its (scaled) delay."""
+    entry = _next(kind, host, key)
+    sleep(entry["elapsed"])
+    return _result(entry)
+
+
+async def replay_async(kind, host, key):
+    entry = _next(kind, host, key)
+    await sleep_async(entry["elapsed"])
+    return _result(entry)
+
+
+def call(kind, host, key, function):
+    """Run function() through the cassette: record it, replay it or just run it."""
+    if replaying():
+        return replay(kind, host, key)
+    if not recording():
+        return function()
+    start = time.monotonic()
+    try:
+        result = function()
+    except Exception as e:
+        record(kind, host, key, elapsed=time.monotonic() - start, error=e)
+        raise
+    record(kind, host, key, result, time.monotonic() - start)
+    return result
+
+
+async def call_async(kind, host, key, function):
+    """call() for a coroutine function."""
+    if replaying():
+        return await replay_async(kind, host, key)
+    if not recording():
+        return await function()
+    start = time.monotonic()
+    try:
+        result = await function()
+    except Exception as e:
+        record(kind, host, key, elapsed=time.monotonic() - start, error=e)
+        raise
+    record(kind, host, key, result, time.monotonic() - start)
+    return result
+
+
+def _scaled(seconds):
+    if not replaying():
+        return seconds
+    return 0 if _speed <= 0 else seconds / _speed
+
+
+def sleep(seconds):
+    """time.sleep, shortened by OSIAS_CASSETTE_SPEED while replaying."""
+    delay = _scaled(seconds)
+    if delay > 0:
+        time.sleep(delay)
+
+
+async def sleep_async(seconds):
+    delay = _scaled(seconds)
+    if delay > 0:
+        await asyncio.sleep(delay)
@@ -2,14 +2,17 @@
 
 import argparse
 import ast
+import asyncio
 import os
-import yaml
-from time import sleep
 
+import cassette
+import maas_api
 import maas_base
 import maas_virtual
 import osias_variables
+import readiness
 import setup_configs
+import ssh_tool
 import utils
 
 
@@ -84,6 +87,12 @@ def parse_args():
         required=False,
         help="Dictionary of values containing the following which over-write the defaults listed in osias_variables.py",
     )
+    parser.add_argument(
+        "--invalidate_upload_cache",
+        action="store_true",
+        help="Forget the content hashes of previously uploaded files so every "
+        + "file is uploaded again.",
+    )
     parser.add_argument(
         "operation",
         type=str,
@@ -120,7 +129,12 @@ def parse_args():
 
 
 def bootstrap_networking(servers_public_ip):
-    utils.run_script_on_server("bootstrap_networking.sh", servers_public_ip)
+    utils.run_script_on_server(
+        "bootstrap_networking.sh",
+        servers_public_ip,
+        files=["base_config.sh"],
+        parallel=True,
+    )
 
 
 def bootstrap_openstack(
@@ -143,12 +157,11 @@ def bootstrap_openstack(
     osias_kolla_imports,
     kolla_base_distro,
 ):
-    utils.copy_file_on_server("requirements.txt", servers_public_ip[0])
-
     utils.run_script_on_server(
         "bootstrap_kolla.sh",
         servers_public_ip[0],
         args=[openstack_release, ansible_version],
+        files=["requirements.txt"],
     )
     setup_configs.setup_kolla_configs(
         controller_nodes,
@@ -170,6 +183,7 @@ def bootstrap_openstack(
         "bootstrap_ssh_access.sh",
         servers_public_ip,
         args=[ssh_priv_key, ssh_public_key],
+        parallel=True,
     )
     utils.run_script_on_server("configure_kolla.sh", servers_public_ip[0])
     if docker_registry_password:
@@ -196,17 +210,33 @@ def bootstrap_openstack(
 
 
 def bootstrap_ceph(servers_public_ip, ceph_release, DATA_CIDR):
-    utils.run_script_on_server(
-        "bootstrap_podman.sh",
-        servers_public_ip,
-    )
     if DATA_CIDR is None or DATA_CIDR == "None":
         DATA_CIDR = ""
-    utils.run_script_on_server(
-        "bootstrap_ceph.sh",
-        servers_public_ip[0],
-        args=[servers_public_ip[0], ceph_release, DATA_CIDR],
+    asyncio.run(_bootstrap_ceph(servers_public_ip, ceph_release, DATA_CIDR))
+
+
+async def _bootstrap_ceph(servers_public_ip, ceph_release, DATA_CIDR):
+    """The ceph bootstrap only needs podman on the first server, so it runs
+    while podman is still being installed on the remaining servers."""
+
+    async def bootstrap_monitor():
+        await utils.run_script_on_server_async(
+            "bootstrap_podman.sh", servers_public_ip[0]
+        )
+        await utils.run_script_on_server_async(
+            "bootstrap_ceph.sh",
+            servers_public_ip[0],
+            args=[servers_public_ip[0], ceph_release, DATA_CIDR],
+        )
+
+    results = await asyncio.gather(
+        bootstrap_monitor(),
+        utils.run_script_on_server_async("bootstrap_podman.sh", servers_public_ip[1:]),
+        return_exceptions=True,
     )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
 
 
 def deploy_ceph(servers_public_ip, storage_nodes_data_ip, enable_swift):
@@ -215,7 +245,10 @@ def deploy_ceph(servers_public_ip, storage_nodes_data_ip, enable_swift):
         "configure_ceph_node_permissions.sh", servers_public_ip[0]
     )
     utils.run_script_on_server(
-        "deploy_ceph.sh", servers_public_ip[0], args=[str(enable_swift)]
+        "deploy_ceph.sh",
+        servers_public_ip[0],
+        args=[str(enable_swift)],
+        files=["swift_settings.sh"],
     )
 
 
@@ -226,7 +259,7 @@ def reprovision_servers(
     distro,
     wipe_physical_servers,
 ):
-    utils.run_cmd("maas login admin {} {}".format(maas_url, maas_api_key))
+    maas_api.login(maas_url, maas_api_key)
     servers = maas_base.MaasBase(distro)
     servers.set_public_ip(servers_public_ip)
     if wipe_physical_servers:
@@ -245,17 +278,17 @@ def verify_network_connectivity(
     active_private_ips = private_ips + data_ips
     count = 0
     while len(public_ips) > 0 and count <= 10:
-        for ip in public_ips:
-            result = utils.check_ip_active(ip)
-            if result is True:
+        results = utils.check_ips_active(public_ips)
+        for ip, active in results.items():
+            if active:
                 functional_public_ip = ip
                 public_ips.remove(ip)
-            if result is False:
-                count = count + 1
-                print(
-                    f"INFO: Attempt {count}/10 - Public IP, {ip}, did not respond, sleeping for 5 seconds."
-                )
-                sleep(5)
+        if len(public_ips) > 0:
+            count = count + 1
+            print(
+                f"INFO: Attempt {count}/10 - Public IP, {public_ips}, did not respond, sleeping for 5 seconds."
+            )
+            cassette.sleep(5)
 
     count = 0
     while len(active_private_ips) > 0 and count <= 10:
@@ -269,7 +302,7 @@ def verify_network_connectivity(
             print(
                 f"INFO: Attempt {count}/10 - Private IP, {private_ip_results['inactive']}, did not respond, sleeping for 5 seconds."
             )
-            sleep(5)
+            cassette.sleep(5)
     print("\nINFO: Completed verification that host IP's are online.")
     print(f"      There were {len(active_private_ips)} errors.\n")
 
@@ -293,10 +326,7 @@ def verify_vm_pool_availability(vm_profile, public_IP_pool):
     internal_subnet = ".".join(vm_profile["Internal_CIDR"].split(".")[:3])
     VIP_ADDRESS_SUFFIX = public_IP_pool[-1].split(".")[-1]
     vip_internal = ".".join((internal_subnet, VIP_ADDRESS_SUFFIX))
-    active_ips = []
-    for ip in public_IP_pool:
-        active_ips.append(utils.check_ip_active(ip))
-    active_ips.append(utils.check_ip_active(vip_internal))
+    active_ips = list(utils.check_ips_active(public_IP_pool + [vip_internal]).values())
     if True in active_ips:
         raise Exception(f"\nERROR: There were {active_ips.count(True)} errors.\n")
 
@@ -311,7 +341,7 @@ def tag_virtual_servers(maas_url, maas_api_key, vm_profile):
     if not parent_project_pipeline_id:
 
         raise Exception("ERROR: <PARENT_PIPELINE_ID> is needed, please set it.")
-    utils.run_cmd(f"maas login admin {maas_url} {maas_api_key}")
+    maas_api.login(maas_url, maas_api_key)
     servers = maas_virtual.MaasVirtual(None)
     osias_variables.VM_Profile.update(vm_profile.items())
     public_IP_pool = servers.get_ip_pool(
@@ -335,7 +365,7 @@ def create_virtual_servers(maas_url, maas_api_key, vm_profile, ceph_enabled):
     parent_project_pipeline_id = os.getenv("PARENT_PIPELINE_ID", "")
     if not parent_project_pipeline_id:
         raise Exception("ERROR: <PARENT_PIPELINE_ID> is needed, please set it.")
-    utils.run_cmd(f"maas login admin {maas_url} {maas_api_key}")
+    maas_api.login(maas_url, maas_api_key)
     servers = maas_virtual.MaasVirtual(
         osias_variables.MAAS_VM_DISTRO[vm_profile["OPENSTACK_RELEASE"]]
     )
@@ -353,18 +383,17 @@ def create_virtual_servers(maas_url, maas_api_key, vm_profile, ceph_enabled):
     optional_vars["POOL_START_IP"] = POOL_START_IP
     optional_vars["POOL_END_IP"] = POOL_END_IP
     optional_vars["VIP_ADDRESS"] = VIP_ADDRESS
-    multinode = utils.create_multinode(server_dict, yaml.dump(optional_vars))
+    multinode = utils.create_multinode(server_dict, optional_vars)
     print(f"Generated multinode is: {multinode}")
-    f = open("MULTINODE.env", "w")
-    f.write(f"{multinode}")
-    f.close()
+    with open("MULTINODE.env", "w") as f:
+        f.write(utils.dump_multinode(multinode))
 
 
 def delete_tags_and_ips(maas_url, maas_api_key, openstack_release=None):
     parent_project_pipeline_id = os.getenv("PARENT_PIPELINE_ID", "")
     if not parent_project_pipeline_id:
         raise Exception("ERROR: PARENT_PIPELINE_ID is needed.")
-    utils.run_cmd("maas login admin {} {}".format(maas_url, maas_api_key))
+    maas_api.login(maas_url, maas_api_key)
     servers = maas_virtual.MaasVirtual(None)
     return servers.delete_tags_and_ips(parent_project_pipeline_id, openstack_release)
 
@@ -397,6 +426,9 @@ def post_deploy_openstack(servers_public_ip, pool_start_ip, pool_end_ip, dns_ip)
 def main():
     args = parse_args()
 
+    if args.invalidate_upload_cache:
+        ssh_tool.invalidate_upload_cache()
+
     if args.config:
         config = utils.parser(args.config)
         controller_nodes = config.get_server_ips(node_type="control", ip_type="private")
@@ -498,7 +530,6 @@ def main():
                     + "the optional arguments [--MAAS_URL] and [--MAAS_API_KEY] have to be set."
                 )
         elif args.operation == "bootstrap_networking":
-            utils.copy_file_on_server("base_config.sh", servers_public_ip)
             bootstrap_networking(servers_public_ip)
         elif args.operation == "verify_connectivity":
             verify_network_connectivity(
@@ -545,13 +576,17 @@ def main():
             )
         elif args.operation == "deploy_ceph":
             if ceph_enabled:
-                utils.copy_file_on_server("swift_settings.sh", servers_public_ip[0])
                 deploy_ceph(servers_public_ip, storage_nodes_data_ip, ENABLE_SWIFT)
             else:
                 print("'Deploy_Ceph' is skipped due to CEPH being DISABLED.")
         elif args.operation == "reboot_servers":
-            utils.run_cmd_on_server("sudo -s shutdown -r 1", servers_public_ip)
-            utils.run_cmd_on_server("echo Server is UP!", servers_public_ip)
+            utils.run_cmd_on_server(
+                "sudo -s shutdown -r 1", servers_public_ip, parallel=True
+            )
+            readiness.forget(servers_public_ip)
+            utils.run_cmd_on_server(
+                "echo Server is UP!", servers_public_ip, parallel=True
+            )
         elif args.operation == "post_deploy_openstack":
             post_deploy_openstack(servers_public_ip, POOL_START_IP, POOL_END_IP, DNS_IP)
         elif args.operation == "test_refstack":
@@ -639,7 +674,7 @@ def main():
                     + "optional arguments [--file_path] has to be set."
                 )
         elif args.operation == "complete_openstack_install":
-            utils.run_script_on_server("bootstrap_networking.sh", servers_public_ip)
+            bootstrap_networking(servers_public_ip)
             bootstrap_openstack(
                 servers_public_ip,
                 servers_private_ip,
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 # docker run -ti -v ~/deploy-openstack-master:/test python:3.7-buster bash
-# pip3 install PyYAML timeout_decorator
+# pip3 install PyYAML
 
 export MAAS_API_KEY="<INSERT KEY HERE>"
 export MAAS_URL="http://<YOUR MAAS IP HERE>:5240/MAAS"
@@ -0,0 +1,141 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+# Traces are only recorded, and written at exit, when OSIAS_TRACE_DIR is set.
+TRACE_DIR = os.getenv("OSIAS_TRACE_DIR")
+
+_events = []
+_lock = threading.Lock()
+
+
+def enabled():
+    return bool(TRACE_DIR)
+
+
+def enable(trace_dir):
+    global TRACE_DIR
+    TRACE_DIR = trace_dir
+
+
+def summarize(command, words=2):
+    """Shorten a command for the trace, arguments may hold secrets such as keys."""
+    if not command:
+        return None
+    return " ".join(str(command).split()[:words])
+
+
+class span:
+    """Time a remote or local operation and record it on exit.
+
+    with instrumentation.span("ssh", host=ip, detail=command) as s:
+        ...
+        s.exit_code = ret
+        s.bytes = len(data)
+    """
+
+    def __init__(self, operation, host=None, detail=None):
+        self.operation = operation
+        self.host = host
+        self.detail = summarize(detail)
+        self.exit_code = None
+        self.bytes = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self._counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not enabled():
+            return False
+        event = {
+            "operation": self.operation,
+            "host": self.host,
+            "detail": self.detail,
+            "start": self.start,
+            "end": self.start + time.perf_counter() - self._counter,
+            "exit_code": self.exit_code,
+            "bytes": self.bytes,
+            "error": exc_type.__name__ if exc_type else None,
+            "thread": threading.get_ident(),
+        }
+        with _lock:
+            _events.append(event)
+        return False
+
+
+def events():
+    with _lock:
+        return list(_events)
+
+
+def export_jsonl(path):
+    with open(path, "w") as f:
+        for event in events():
+            f.write(json.dumps(event) + "\n")
+
+
+def export_chrome_trace(path):
+    """Write the events in the Chrome trace-event format, one lane per host.
+
+    Spans of the same host run by different threads, e.g. concurrent MAAS
+    calls, get a lane each so that their slices never overlap.
+    Open the file in chrome://tracing or https://ui.perfetto.dev."""
+    pid = os.getpid()
+    lanes = {}
+    threads_per_host = {}
+    trace_events = []
+    for event in events():
+        host = event["host"] or "local"
+        lane = (host, event["thread"])
+        if lane not in lanes:
+            lanes[lane] = len(lanes) + 1
+            threads_per_host[host] = threads_per_host.get(host, 0) + 1
+            name = host
+            if threads_per_host[host] > 1:
+                name = f"{host} #{threads_per_host[host]}"
+            trace_events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": lanes[lane],
+                    "args": {"name": name},
+                }
+            )
+        trace_events.append(
+            {
+                "name": event["detail"] or event["operation"],
+                "cat": event["operation"],
+                "ph": "X",
+                "ts": int(event["start"] * 1e6),
+                "dur": int((event["end"] - event["start"]) * 1e6),
+                "pid": pid,
+                "tid": lanes[lane],
+                "args": {
+                    "exit_code": event["exit_code"],
+                    "bytes": event["bytes"],
+                    "error": event["error"],
+                },
+            }
+        )
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+def export(trace_dir=None):
+    """Write <pid>.jsonl and <pid>.trace.json into the trace directory."""
+    trace_dir = trace_dir or TRACE_DIR
+    if not trace_dir or not events():
+        return
+    os.makedirs(trace_dir, exist_ok=True)
+    name = f"osias-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    export_jsonl(os.path.join(trace_dir, f"{name}.jsonl"))
+    export_chrome_trace(os.path.join(trace_dir, f"{name}.trace.json"))
+    print(f"Trace of remote operations written to {trace_dir}/{name}.*")
+
+
+atexit.register(export)
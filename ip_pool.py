@@ -0,0 +1,136 @@
+import bisect
+import ipaddress
+import random
+import socket
+
+# Where a block is placed inside the free space of a subnet.
+RANDOM = "random"  # random offset in the lowest free gap that fits, as before
+LOWEST = "lowest"  # start of the lowest free gap that fits
+BEST_FIT = "best_fit"  # start of the smallest free gap that fits
+PLACEMENTS = (RANDOM, LOWEST, BEST_FIT)
+
+
+def merge_intervals(intervals):
+    """Sort and merge overlapping or adjacent inclusive (start, end) intervals."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+class IpAllocator:
+    """Free addresses of a subnet, kept as merged integer intervals.
+
+    Nothing is expanded per address, so any prefix length works and blocks
+    may cross octet boundaries."""
+
+    def __init__(self, cidr, used):
+        network = ipaddress.ip_network(cidr, strict=False)
+        first, last = int(network.network_address), int(network.broadcast_address)
+        if network.num_addresses > 2:
+            # The network and broadcast addresses can never be handed out.
+            first, last = first + 1, last - 1
+        self._address_class = type(network.network_address)
+        self.used = merge_intervals(
+            (max(start, first), min(end, last))
+            for start, end in used
+            if start <= last and end >= first
+        )
+        self.free = []
+        cursor = first
+        for start, end in self.used:
+            if start > cursor:
+                self.free.append((cursor, start - 1))
+            cursor = end + 1
+        if cursor <= last:
+            self.free.append((cursor, last))
+        # (size, start) of every gap, for the O(log n) best-fit lookup.
+        self._by_size = sorted((end - start + 1, start) for start, end in self.free)
+        # Segment tree over the gaps in address order, each node holds the
+        # largest gap below it, for the O(log n) lowest-fit lookup.
+        self._leaves = 1
+        while self._leaves < len(self.free):
+            self._leaves *= 2
+        self._largest = [0] * (2 * self._leaves)
+        for index, (start, end) in enumerate(self.free):
+            self._largest[self._leaves + index] = end - start + 1
+        for node in range(self._leaves - 1, 0, -1):
+            self._largest[node] = max(
+                self._largest[2 * node], self._largest[2 * node + 1]
+            )
+
+    def _lowest_fit(self, size):
+        """(start, end) of the lowest gap with room for size addresses, or None."""
+        if not self.free or self._largest[1] < size:
+            return None
+        node = 1
+        while node < self._leaves:
+            # Go left whenever the lower half has a gap that is large enough.
+            node = 2 * node if self._largest[2 * node] >= size else 2 * node + 1
+        return self.free[node - self._leaves]
+
+    def find(self, size, placement=RANDOM):
+        """First address of a free block of `size` addresses, or None."""
+        if placement not in PLACEMENTS:
+            raise Exception(f"ERROR: Unknown IP placement, {placement}.")
+        if placement == BEST_FIT:
+            index = bisect.bisect_left(self._by_size, (size, -1))
+            if index == len(self._by_size):
+                return None
+            return self._by_size[index][1]
+        gap = self._lowest_fit(size)
+        if gap is None:
+            return None
+        start, end = gap
+        if placement == LOWEST:
+            return start
+        return random.randint(start, end - size + 1)
+
+    def allocate(self, size, placement=RANDOM):
+        """Addresses of a free block of `size`, as strings, or None."""
+        start = self.find(size, placement)
+        if start is None:
+            return None
+        return [str(self._address_class(value)) for value in range(start, start + size)]
+
+
+def ip_to_int(ip):
+    """Integer value of an IP; dotted quads skip the ipaddress objects."""
+    try:
+        return 4, int.from_bytes(socket.inet_aton(ip), "big")
+    except OSError:
+        address = ipaddress.ip_address(ip)
+        return address.version, int(address)
+
+
+class CidrClassifier:
+    """Label IPs with the first of several networks they belong to.
+
+    The networks are parsed once into integer masks, each IP is then a
+    single conversion plus an AND per network."""
+
+    def __init__(self, labelled_cidrs):
+        self._networks = []
+        for label, cidr in labelled_cidrs:
+            if not cidr:
+                continue
+            network = ipaddress.ip_network(cidr, strict=False)
+            self._networks.append(
+                (
+                    network.version,
+                    int(network.netmask),
+                    int(network.network_address),
+                    label,
+                )
+            )
+
+    def classify(self, ip):
+        """Label of the first network containing ip, or None."""
+        version, value = ip_to_int(ip)
+        for network_version, mask, network, label in self._networks:
+            if version == network_version and value & mask == network:
+                return label
+        return None
@@ -1,50 +1,230 @@
 #!/usr/bin/python3
 
-import copy
+import cassette
 import json
-import timeout_decorator
 import time
 import utils
-import random
+import instrumentation
+import maas_api
+import ip_pool
+import os
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import osias_variables
-import ast
-from ipaddress import IPv4Network, IPv4Address
+import re
+from ipaddress import ip_address
+
+# States a machine cannot leave on its own, "Failed deployment" is retried.
+FAILED_STATES = {
+    "Failed deployment",
+    "Failed commissioning",
+    "Failed releasing",
+    "Failed disk erasing",
+    "Failed testing",
+}
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"\s*")
+
+
+def iter_json_records(data):
+    """Yield the records of a MAAS/jq response one at a time.
+
+    Handles a single JSON document as well as the newline-delimited (or
+    pretty-printed, concatenated) objects jq emits; top-level lists are
+    flattened into their elements."""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    index = _whitespace.match(data).end()
+    while index < len(data):
+        value, index = _decoder.raw_decode(data, index)
+        if isinstance(value, list):
+            yield from value
+        else:
+            yield value
+        index = _whitespace.match(data, index).end()
+
+
+class Machine_State_Failed(Exception):
+    def __init__(self, message, failures):
+        super().__init__(message)
+        self.failures = failures
+
+
+class MachineProgress:
+    """Where one machine is on its way to the desired status."""
+
+    def __init__(self, system_id, desired_status, timeout, retries):
+        self.system_id = system_id
+        self.desired_status = desired_status
+        self.retries_left = retries
+        self.redeploying = False
+        self.pending = None
+        self.done = False
+        self.error = None
+        self.restart(timeout)
+
+    def restart(self, timeout):
+        """Start a new attempt with a full deadline."""
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+        self.redeploying = False
+
+    def fail(self, reason):
+        print(f"STATE: {self.system_id} failed, {reason}.")
+        self.error = reason
+
+    @property
+    def finished(self):
+        return self.done or self.error is not None
+
+
+class MachineInventory:
+    """Snapshot of `machines read`, indexed by system_id, tag and IP.
+
+    Machines changed by our own commands are marked stale and re-read on
+    their own instead of fetching the whole list again."""
+
+    def __init__(self, records, fetched_at):
+        self.machines = {}
+        self.by_tag = {}
+        self.by_ip = {}
+        self.stale = set()
+        self.fetched_at = fetched_at
+        self.update(records)
+
+    def _unindex(self, system_id):
+        record = self.machines[system_id]
+        for index, keys in (
+            (self.by_tag, record.get("tag_names")),
+            (self.by_ip, record.get("ip_addresses")),
+        ):
+            # A record may repeat an IP or tag, it was indexed once.
+            for key in keys or []:
+                bucket = index.get(key)
+                if bucket is None:
+                    continue
+                bucket.pop(system_id, None)
+                if not bucket:
+                    del index[key]
+
+    def update(self, records, system_ids=()):
+        """Store fresh records; requested ids MAAS did not return are dropped."""
+        returned = set()
+        for record in records:
+            system_id = record["system_id"]
+            returned.add(system_id)
+            if system_id in self.machines:
+                self._unindex(system_id)
+            # Assigning in place keeps the MAAS ordering of the snapshot.
+            self.machines[system_id] = record
+            for tag in record.get("tag_names") or []:
+                self.by_tag.setdefault(tag, {})[system_id] = None
+            for ip in record.get("ip_addresses") or []:
+                self.by_ip.setdefault(ip, {})[system_id] = None
+        for system_id in set(system_ids) - returned:
+            if system_id in self.machines:
+                self._unindex(system_id)
+                del self.machines[system_id]
+        self.stale.difference_update(system_ids)
+
+    def records(self, system_ids=None):
+        if system_ids is None:
+            return list(self.machines.values())
+        return [self.machines[i] for i in system_ids if i in self.machines]
+
+    def with_ips(self, ips):
+        """system_ids owning any of the IPs, in the order of the IPs."""
+        found = {}
+        for ip in ips:
+            found.update(self.by_ip.get(ip, {}))
+        return list(found)
+
+    def with_tag_containing(self, text):
+        """system_ids with a tag containing text, like jq's `contains`."""
+        found = {}
+        for tag, system_ids in self.by_tag.items():
+            if text in tag:
+                found.update(system_ids)
+        return list(found)
 
 
 class MaasBase:
+    # Seconds a full `machines read` snapshot is reused for.
+    INVENTORY_TTL = 10
+    # Per machine, per attempt deadline and re-deploys after a failed deployment.
+    WAIT_TIMEOUT = 2500
+    DEPLOY_RETRIES = 2
+    # Machines asked for per filtered `machines read id=...` poll.
+    POLL_BATCH = 50
+    # deploy/release/commission requests in flight at once.
+    SUBMIT_WORKERS = 8
+    IP_PLACEMENT = os.getenv("OSIAS_IP_PLACEMENT", ip_pool.RANDOM)
+
     def __init__(self, distro):
         self.fs_type = "ext4"
         self.distro = distro
+        self._machines = None
+        self._inventory_lock = threading.Lock()
+
+    def _maas_output(self, command):
+        with instrumentation.span("maas", detail=command) as span:
+            client = maas_api.get_client()
+            if client:
+                result = cassette.call(
+                    "maas", None, command, lambda: client.run(command)
+                )
+            else:
+                result = cassette.call(
+                    "maas",
+                    None,
+                    command,
+                    lambda: utils.run_cmd(f"maas admin {command}", output=False),
+                )
+            span.bytes = len(result or b"")
+        return result
 
     def _run_maas_command(self, command):
-        result = utils.run_cmd(f"maas admin {command}", output=False)
+        result = self._maas_output(command)
         if result == b"":
             return result
         try:
             return json.loads(result)
         except ValueError:
-            # This is to fix a poorly formatted list of dictionaries
-            result = ast.literal_eval(
-                str(result)
-                .replace("}\\n{", "},{")
-                .replace("\\n", "")
-                .replace("b'", "[")
-                .replace("}'", "}]")
-            )
-            if not isinstance(result, list):
-                result = result.decode("utf-8")
-                result = result.rstrip()
-                result = result.replace("null", "'Null'")
-                result = [ast.literal_eval(i) for i in result.split("\n")]
-            return result
+            # jq --compact-output prints one object per line
+            return list(iter_json_records(result))
+
+    def _iter_maas_records(self, command):
+        """Run a command and yield its records as they are decoded."""
+        return iter_json_records(self._maas_output(command))
+
+    def _inventory(self):
+        """The cached machine inventory, refreshed when expired or stale."""
+        with self._inventory_lock:
+            now = time.monotonic()
+            if (
+                self._machines is None
+                or now - self._machines.fetched_at > self.INVENTORY_TTL
+            ):
+                self._machines = MachineInventory(
+                    self._run_maas_command("machines read"), now
+                )
+            elif self._machines.stale:
+                system_ids = sorted(self._machines.stale)
+                records = self._run_maas_command(
+                    "machines read " + " ".join(f"id={i}" for i in system_ids)
+                )
+                self._machines.update(records, system_ids)
+            return self._machines
+
+    def _invalidate_machines(self, system_ids):
+        """Mark machines we changed so the next lookup re-reads just them."""
+        with self._inventory_lock:
+            if self._machines is not None:
+                self._machines.stale.update(system_ids)
 
     def _find_machine_ids(self):
-        machine_list = self._run_maas_command("machines read")
-        deployment_list = []
-        for machine in machine_list:
-            check = any(item in self.public_ips for item in machine["ip_addresses"])
-            if check:
-                deployment_list.append(machine["system_id"])
+        deployment_list = self._inventory().with_ips(self.public_ips)
         self.machine_list = deployment_list
         if not deployment_list:
             raise Exception(
@@ -52,153 +232,212 @@ class MaasBase:
             )
         return deployment_list
 
-    def _get_all_used_ips(self, cidr: str):
-        reserved_ips = self._run_maas_command(f"subnet reserved-ip-ranges {cidr}")
-        used_ips = []
-        for item in reserved_ips:
-            start = item["start"]
-            ip0 = int(start.split(".")[-1])
-            num_ips = item["num_addresses"]
-            prefix = start[: start.rfind(".")]  # first 3 octets of cidr
-            ip_list = range(ip0, ip0 + num_ips)
-            for ip in ip_list:
-                used_ips.append(f"{prefix}.{ip}")
-        return used_ips
+    def _get_used_ranges(self, cidr: str):
+        """Reserved and assigned addresses of a subnet as (start, end) integers."""
+        used = []
+        for item in self._run_maas_command(f"subnet reserved-ip-ranges {cidr}"):
+            start = int(ip_address(item["start"]))
+            used.append((start, start + item["num_addresses"] - 1))
+        return used
 
     def _parse_ip_types(self, machine_ids: list, machine_info: list, vm_profile):
         """Given a list of servers and machine info, return a parsed list of info."""
-        results = {}
-        if vm_profile:
-            for machine in machine_ids:
-                for info in machine_info:
-                    if machine == info["system_id"]:
-                        ips = info["ip_addresses"]
-                        temp = {}
-                        osias_variables.VM_Profile.update(vm_profile.items())
-                        for ip in ips:
-                            if IPv4Address(ip) in IPv4Network(
-                                osias_variables.VM_Profile["Internal_CIDR"]
-                            ):
-                                label = "internal"
-                            if IPv4Address(ip) in IPv4Network(
-                                osias_variables.VM_Profile["Data_CIDR"]
-                            ):
-                                label = "data"
-                            if IPv4Address(ip) in IPv4Network(
-                                osias_variables.VM_Profile["VM_DEPLOYMENT_CIDR"]
-                            ):
-                                label = "public"
-                            temp[label] = ip
-                        results[machine] = temp
-            print(results)
-            return results
-        else:
+        if not vm_profile:
             raise Exception("Logic Error: no vm_profile specified.")
+        profile = {**osias_variables.VM_Profile, **vm_profile}
+        # Checked in this order, an IP in several networks takes the first label.
+        classifier = ip_pool.CidrClassifier(
+            (
+                ("public", profile["VM_DEPLOYMENT_CIDR"]),
+                ("data", profile.get("Data_CIDR")),
+                ("internal", profile.get("Internal_CIDR")),
+            )
+        )
+        info_by_id = {info["system_id"]: info for info in machine_info}
+        results = {}
+        for machine in machine_ids:
+            if machine not in info_by_id:
+                continue
+            temp = {}
+            for ip in info_by_id[machine]["ip_addresses"]:
+                label = classifier.classify(ip)
+                if label:
+                    temp[label] = ip
+            results[machine] = temp
+        print(results)
+        return results
+
+    def _submit(self, action, machines, policy=utils.QUORUM, distro=None):
+        """Submit `machine <action>` for all machines at once, SUBMIT_WORKERS at a time.
+
+        With the default policy a rejected submission does not raise, the
+        per-machine results are handed to _waiting, which fails just those.
+        Deployments use distro, self.distro by default."""
+        machines = list(machines)
+
+        def submit(machine):
+            if action == "deploy":
+                self._run_maas_command(self._deploy_command(machine, distro))
+            else:
+                self._run_maas_command(f"machine {action} {machine}")
+            return 0, b""
+
+        try:
+            return utils.fan_out(
+                submit,
+                machines,
+                policy,
+                self.SUBMIT_WORKERS,
+                tolerated_failures=len(machines),
+            )
+        finally:
+            self._invalidate_machines(machines)
 
     def _release(self):
-        for machine in self.machine_list[:]:
-            self._run_maas_command(f"machine release {machine}")
-        self._waiting(self.machine_list, "Ready")
+        submissions = self._submit("release", self.machine_list)
+        self._waiting(self.machine_list, "Ready", submissions)
 
-    @timeout_decorator.timeout(2500, timeout_exception=StopIteration)
-    def _waiting(self, server_list: list, desired_status: str):
+    def _poll_machines(self, servers):
+        """Current records of just these machines, keyed on system_id."""
+        machines = {}
+        for index in range(0, len(servers), self.POLL_BATCH):
+            batch = servers[index : index + self.POLL_BATCH]
+            for machine in self._iter_maas_records(
+                "machines read " + " ".join(f"id={server}" for server in batch)
+            ):
+                machines[machine["system_id"]] = machine
+        return machines
+
+    def _advance(self, progress, machine, executor):
+        """Move one machine's progress along from its latest polled record."""
+        if progress.pending is not None:
+            if not progress.pending.done():
+                return
+            error = progress.pending.exception()
+            progress.pending = None
+            if error is not None:
+                progress.fail(f"MAAS command failed: {error}")
+                return
+        if machine is None:
+            print(f"SERVER: {progress.system_id} - not returned by MAAS yet.")
+        else:
+            server = progress.system_id
+            current_status = machine["status_name"]
+            print(
+                f"SERVER: {server} - CURRENT STATUS: {current_status} - {machine['status_message']} - DESIRED STATUS: {progress.desired_status}\n"
+            )
+            if progress.redeploying:
+                if current_status == "Ready":
+                    print("STATE: Re-deploying.")
+                    progress.restart(self.WAIT_TIMEOUT)
+                    progress.pending = executor.submit(
+                        self._run_maas_command, self._deploy_command(server)
+                    )
+                    return
+            elif current_status == progress.desired_status:
+                print("STATE: COMPLETE.")
+                progress.done = True
+                return
+            elif (
+                current_status == "Failed deployment"
+                and progress.desired_status == "Deployed"
+                and progress.retries_left > 0
+            ):
+                progress.retries_left -= 1
+                progress.redeploying = True
+                print(
+                    f"STATE: Deployment failed, releasing to retry ({progress.retries_left} retries left)."
+                )
+                progress.pending = executor.submit(
+                    self._run_maas_command, f"machine release {server}"
+                )
+                return
+            if current_status in FAILED_STATES and not (
+                # The release we asked for may not have been picked up yet.
+                progress.redeploying
+                and current_status == "Failed deployment"
+            ):
+                progress.fail(current_status)
+                return
+            print("STATE: Waiting")
+        if time.monotonic() > progress.deadline:
+            progress.fail(
+                f"did not reach {progress.desired_status} within {progress.timeout} seconds"
+            )
+
+    def _waiting(self, server_list: list, desired_status: str, submissions=None):
+        """Poll until every machine reaches desired_status.
+
+        Each machine has its own deadline and re-deploy budget, failed
+        deployments are released and re-deployed in the background while
+        the other machines keep being polled. Machines whose submission in
+        `submissions` (from _submit) failed are failed straight away. Safe to
+        call from threads."""
+        progress = {
+            server: MachineProgress(
+                server, desired_status, self.WAIT_TIMEOUT, self.DEPLOY_RETRIES
+            )
+            for server in server_list
+        }
+        for rejected in submissions.failed if submissions else []:
+            progress[rejected.host].fail(f"MAAS rejected the request: {rejected.error}")
+        machine_info = {}
         timer_loop_counter = 1
-        servers = copy.deepcopy(server_list)
-        print(f"Waiting for {servers} to reach desired state, {desired_status}.")
-        while len(servers) > 0:
-            if len(servers) == 1:
-                read_cmd = f"machine read {servers[0]} | jq '"
-            else:
-                read_cmd = "machines read | jq '.[] | "
-            fields = "{system_id:.system_id,status_name:.status_name,status_message:.status_message,pool_name:.pool.name,ip_addresses:.ip_addresses}' --compact-output"
-            machine_info_list = self._run_maas_command(f"{read_cmd}{fields}")
-            if isinstance(machine_info_list, dict):
-                # `machine read` returns dict, `machines read` returns a list
-                machine_info_list = [machine_info_list]
-            for server in servers[:]:
-                for machine in machine_info_list:
-                    if server in machine["system_id"]:
-                        current_status = machine["status_name"]
-                        status_message = machine["status_message"]
-                        print(
-                            f"SERVER: {server} - CURRENT STATUS: {current_status} - {status_message} - DESIRED STATUS: {desired_status}\n"
-                        )
-                        if current_status == desired_status:
-                            print("STATE: COMPLETE.")
-                            servers.remove(server)
-                            break
-                        elif current_status == "Failed deployment":
-                            self._run_maas_command(f"machine release {server}")
-                            self._waiting([server], "Ready")
-                            print("STATE: Re-deploying.")
-                            self.deploy([server])
-                        elif current_status == "Failed commissioning":
-                            print("STATE: Commissioning Failed, exiting.")
-                            break
-                        else:
-                            print("STATE: Waiting")
-                    else:
-                        continue
-            if len(servers) > 0:
-                # This will slowly speed up the timer, reducing time as follows: [30, 23, 20, 18, 17, 16, 15, 15, 14, ...]
-                ttime = int((30 / timer_loop_counter ** (1 / 3)))
-                print(f"Sleeping {ttime} seconds.")
-                time.sleep(ttime)
-                timer_loop_counter = timer_loop_counter + 1
-            else:
-                continue
+        print(f"Waiting for {server_list} to reach desired state, {desired_status}.")
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            while True:
+                active = [p for p in progress.values() if not p.finished]
+                if not active:
+                    break
+                machine_info.update(self._poll_machines([p.system_id for p in active]))
+                for p in active:
+                    self._advance(p, machine_info.get(p.system_id), executor)
+                if any(not p.finished for p in progress.values()):
+                    # This will slowly speed up the timer, reducing time as follows: [30, 23, 20, 18, 17, 16, 15, 15, 14, ...]
+                    ttime = int((30 / timer_loop_counter ** (1 / 3)))
+                    print(f"Sleeping {ttime} seconds.")
+                    cassette.sleep(ttime)
+                    timer_loop_counter = timer_loop_counter + 1
+        self._invalidate_machines(server_list)
+        failed = {p.system_id: p.error for p in progress.values() if p.error}
+        if failed:
+            raise Machine_State_Failed(
+                f"ERROR: Machines did not reach {desired_status}: {failed}", failed
+            )
         print("All servers have reached the desired state.")
-        return machine_info_list
+        return [machine_info[server] for server in server_list]
+
+    def _deploy_command(self, machine, distro=None):
+        return f"machine deploy {machine} distro_series={distro or self.distro}"
 
     def deploy(self, server_list=None):
         if server_list:
             server_list = server_list
         else:
             server_list = self.machine_list
-        for machine in server_list[:]:
-            self._run_maas_command(
-                f"machine deploy {machine} distro_series={self.distro}"
-            )
-        machine_info = self._waiting(server_list[:], "Deployed")
+        submissions = self._submit("deploy", server_list)
+        machine_info = self._waiting(server_list[:], "Deployed", submissions)
+
+    def commission(self, server_list=None):
+        server_list = server_list or self.machine_list
+        submissions = self._submit("commission", server_list)
+        return self._waiting(server_list[:], "Ready", submissions)
 
     def get_machines_info(self):
-        return self._run_maas_command("machines read")
-
-    def get_ip_pool(self, cidr: str, gap: int):
-        used_ips = self._get_all_used_ips(cidr)
-
-        sorted_list_of_ips = []
-        for ip in sorted(used_ips, key=lambda ip: [int(ip) for ip in ip.split(".")]):
-            sorted_list_of_ips.append(ip)
-        ips_available = [
-            abs(int(x[1].split(".")[-1]) - int(x[0].split(".")[-1]))
-            for x in zip(sorted_list_of_ips[1:], sorted_list_of_ips)
-        ]
-
-        for index, diff in enumerate(ips_available):
-            if diff > gap:
-                prefix = sorted_list_of_ips[index][
-                    : sorted_list_of_ips[index].rfind(".")
-                ]  # first 3 octets of cidr
-                if diff > gap:
-                    first_ip_last_octet = random.randint(
-                        int(sorted_list_of_ips[index].split(".")[-1]) + 1,
-                        int(sorted_list_of_ips[index].split(".")[-1])
-                        + ips_available[index]
-                        - gap,
-                    )
-                last_ip_last_octet = first_ip_last_octet + gap - 1
-                first_ip = f"{prefix}.{first_ip_last_octet}"
-                last_ip = f"{prefix}.{last_ip_last_octet}"
-                self._run_maas_command(f"ipaddresses reserve ip={last_ip}")
-                self._run_maas_command(f"ipaddresses reserve ip={first_ip}")
-                ip_pool = [
-                    prefix + "." + str(i)
-                    for i in range(first_ip_last_octet, last_ip_last_octet + 1)
-                ]
-                return ip_pool
-        else:
+        return self._inventory().records()
+
+    def get_ip_pool(self, cidr: str, gap: int, placement=None):
+        """Reserve a block of `gap` consecutive free IPs in cidr and return them.
+
+        placement is one of ip_pool.PLACEMENTS, IP_PLACEMENT by default; random
+        placement keeps concurrent pipelines from racing for the same block."""
+        allocator = ip_pool.IpAllocator(cidr, self._get_used_ranges(cidr))
+        pool = allocator.allocate(gap, placement or self.IP_PLACEMENT)
+        if pool is None:
             raise Exception("ERROR: No more valid IPs available.")
+        self._run_maas_command(f"ipaddresses reserve ip={pool[-1]}")
+        self._run_maas_command(f"ipaddresses reserve ip={pool[0]}")
+        return pool
 
     def release_ip_pool(self, *ips):
         for ip in ips:
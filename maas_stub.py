@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+"""Small in-memory MAAS API server for working on Osias without a MAAS.
+
+Implements the subset of the MAAS 2.0 API that maas_base and maas_virtual use,
+checks the OAuth header like MAAS does and moves machines through their
+deploy/release states after a configurable delay.
+
+    python3 maas_stub.py --port 5240 [--fixtures machines.json]
+
+then point deploy.py at it with --MAAS_URL http://127.0.0.1:5240/MAAS and the
+printed --MAAS_API_KEY."""
+
+import argparse
+import copy
+import ipaddress
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+API_KEY = "stub:stub:stub"
+TRANSITIONS = {
+    "Deploying": "Deployed",
+    "Releasing": "Ready",
+    "Commissioning": "Ready",
+}
+
+DEFAULT_FIXTURES = {
+    "machines": [
+        {
+            "system_id": f"stub{index:02d}",
+            "hostname": f"stub-{index:02d}",
+            "status_name": "Ready",
+            "status_message": "",
+            "pool": {"name": "default"},
+            "distro_series": "",
+            "tag_names": [],
+            "ip_addresses": [f"10.245.121.{10 + index}", f"192.168.3.{10 + index}"],
+            "interface_set": [
+                {"id": index * 10 + 1, "name": "eno1", "links": []},
+                {"id": index * 10 + 2, "name": "eno2", "links": []},
+                {"id": index * 10 + 3, "name": "eno3", "links": []},
+            ],
+        }
+        for index in range(1, 4)
+    ],
+    "subnets": [
+        {
+            "id": 1,
+            "cidr": "10.245.121.0/24",
+            "name": "10.245.121.0/24",
+            "reserved": [
+                ["10.245.121.1", "10.245.121.1"],
+                ["10.245.121.200", "10.245.121.254"],
+            ],
+        },
+        {
+            "id": 2,
+            "cidr": "192.168.3.0/24",
+            "name": "192.168.3.0/24",
+            "reserved": [["192.168.3.1", "192.168.3.1"]],
+        },
+    ],
+    "pods": [],
+    "tags": ["openstack_ready"],
+}
+
+
+def parse_form(content_type, body):
+    """Decode a multipart/form-data or urlencoded body into (key, value) pairs."""
+    if not body:
+        return []
+    if content_type.startswith("multipart/form-data"):
+        boundary = content_type.split("boundary=", 1)[1].strip('"')
+        fields = []
+        for part in body.split(f"--{boundary}".encode())[1:-1]:
+            headers, _, value = part.strip(b"\r\n").partition(b"\r\n\r\n")
+            name = re.search(rb'name="([^"]*)"', headers).group(1).decode()
+            fields.append((name, value.decode()))
+        return fields
+    return parse_qsl(body.decode(), keep_blank_values=True)
+
+
+class MaasState:
+    """The inventory served by the stub, shared by every request thread."""
+
+    def __init__(self, fixtures, delay):
+        self.lock = threading.Lock()
+        self.delay = delay
+        # Deep copies, requests change nested lists such as tag_names.
+        fixtures = copy.deepcopy(fixtures)
+        self.machines = {m["system_id"]: m for m in fixtures["machines"]}
+        self.subnets = fixtures["subnets"]
+        self.pods = fixtures.get("pods", [])
+        self.tags = set(fixtures.get("tags", []))
+        self.reserved = set()
+        self.changed = {}
+        # system_id -> number of deployments that should end in a failure.
+        self.deploy_failures = dict(fixtures.get("deploy_failures", {}))
+
+    def _set_status(self, system_id, status):
+        self.machines[system_id]["status_name"] = status
+        self.changed[system_id] = time.monotonic()
+
+    def machine(self, system_id):
+        machine = self.machines[system_id]
+        status = machine["status_name"]
+        if status in TRANSITIONS:
+            if time.monotonic() - self.changed[system_id] >= self.delay:
+                machine["status_name"] = TRANSITIONS[status]
+                if status == "Deploying" and self.deploy_failures.get(system_id):
+                    self.deploy_failures[system_id] -= 1
+                    machine["status_name"] = "Failed deployment"
+        return machine
+
+    def reserved_ranges(self, subnet):
+        network = ipaddress.ip_network(subnet["cidr"])
+        used = set(self.reserved)
+        for machine in self.machines.values():
+            used.update(machine["ip_addresses"])
+        # Gateway and dynamic ranges, given as [first, last] pairs.
+        for first, last in subnet.get("reserved", []):
+            first, last = ipaddress.ip_address(first), ipaddress.ip_address(last)
+            used.update(str(first + i) for i in range(int(last) - int(first) + 1))
+        ranges = []
+        for ip in sorted(ipaddress.ip_address(i) for i in used):
+            if ip not in network:
+                continue
+            if ranges and int(ip) == int(ranges[-1][1]) + 1:
+                ranges[-1][1] = ip
+            else:
+                ranges.append([ip, ip])
+        return [
+            {
+                "start": str(start),
+                "end": str(end),
+                "num_addresses": int(end) - int(start) + 1,
+                "purpose": ["assigned-ip"],
+            }
+            for start, end in ranges
+        ]
+
+    def handle(self, method, path, query, form):
+        """Dispatch one API call, returning (status, JSON-able body)."""
+        op = query.get("op")
+        parts = [unquote(p) for p in path.strip("/").split("/")]
+        resource = parts[0]
+        if resource == "machines":
+            if len(parts) == 1:
+                ids = [v for k, v in query.items(multi=True) if k == "id"]
+                machines = [self.machine(i) for i in self.machines]
+                return 200, [m for m in machines if not ids or m["system_id"] in ids]
+            system_id = parts[1]
+            if system_id not in self.machines:
+                return 404, "No Machine matches the given query."
+            if op == "deploy":
+                self.machines[system_id]["distro_series"] = form.get(
+                    "distro_series", ""
+                )
+                self._set_status(system_id, "Deploying")
+            elif op == "release":
+                self._set_status(system_id, "Releasing")
+            elif op == "commission":
+                self._set_status(system_id, "Commissioning")
+            return 200, self.machine(system_id)
+        if resource == "subnets":
+            if len(parts) == 1:
+                return 200, self.subnets
+            subnet = [s for s in self.subnets if str(s["id"]) == parts[1]]
+            if not subnet:
+                return 404, "No Subnet matches the given query."
+            if op == "reserved_ip_ranges":
+                return 200, self.reserved_ranges(subnet[0])
+            return 200, subnet[0]
+        if resource == "ipaddresses":
+            ip = form.get("ip")
+            if op == "reserve":
+                if ip in self.reserved:
+                    return 404, f"The IP address {ip} is already in use."
+                self.reserved.add(ip)
+                return 200, {"ip": ip, "alloc_type_name": "User reserved"}
+            if op == "release":
+                self.reserved.discard(ip)
+                return 204, None
+        if resource in ("pods", "vm-hosts"):
+            if len(parts) == 1:
+                return 200, self.pods
+            if op == "compose":
+                system_id = f"vm{len(self.machines):04d}"
+                self.machines[system_id] = dict(
+                    copy.deepcopy(DEFAULT_FIXTURES["machines"][0]),
+                    system_id=system_id,
+                    hostname=system_id,
+                    pool={"name": "virtual_machine_pool"},
+                    ip_addresses=[],
+                    tag_names=[],
+                )
+                self._set_status(system_id, "Commissioning")
+                return 200, {"system_id": system_id, "resource_uri": ""}
+        if resource == "tags":
+            if len(parts) == 1 and method == "POST":
+                self.tags.add(form["name"])
+                return 200, {"name": form["name"], "comment": form.get("comment", "")}
+            tag = parts[1]
+            if method == "DELETE":
+                self.tags.discard(tag)
+                for machine in self.machines.values():
+                    if tag in machine["tag_names"]:
+                        machine["tag_names"].remove(tag)
+                return 204, None
+            if op == "update_nodes":
+                for key, system_id in form.items(multi=True):
+                    tags = self.machines[system_id]["tag_names"]
+                    if key == "add" and tag not in tags:
+                        tags.append(tag)
+                    elif key == "remove" and tag in tags:
+                        tags.remove(tag)
+                return 200, {"added": 0, "removed": 0}
+        if resource == "nodes":
+            # Interface changes are accepted but do not change the inventory.
+            return 200, {"system_id": parts[1]}
+        return 404, f"Unknown endpoint {method} {path} op={op}"
+
+
+class MultiDict(dict):
+    """First value per key as a dict, every pair through items(multi=True)."""
+
+    def __init__(self, pairs):
+        super().__init__(reversed(pairs))
+        self.pairs = pairs
+
+    def items(self, multi=False):
+        return list(self.pairs) if multi else super().items()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, keep-alive needs TCP_NODELAY.
+    disable_nagle_algorithm = True
+
+    def _respond(self, status, body):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        consumer, token, secret = self.server.api_key.split(":")
+        auth = self.headers.get("Authorization", "")
+        if (
+            'oauth_signature_method="PLAINTEXT"' not in auth
+            or f'oauth_consumer_key="{consumer}"' not in auth
+            or f'oauth_token="{token}"' not in auth
+            or f'oauth_signature="%26{secret}"' not in auth
+        ):
+            self._respond(401, "Authorization Error: Invalid API key.")
+            return
+        url = urlsplit(self.path)
+        path = url.path.split("/api/2.0/", 1)[-1]
+        query = MultiDict(parse_qsl(url.query, keep_blank_values=True))
+        form = MultiDict(parse_form(self.headers.get("Content-Type", ""), body))
+        with self.server.state.lock:
+            status, result = self.server.state.handle(self.command, path, query, form)
+        self._respond(status, result)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(port=0, fixtures=None, delay=5, api_key=API_KEY, verbose=False):
+    """Start the stub in a background thread and return the server."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.state = MaasState(fixtures or DEFAULT_FIXTURES, delay)
+    server.api_key = api_key
+    server.verbose = verbose
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/MAAS"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=5240)
+    parser.add_argument(
+        "--fixtures",
+        help="JSON file with machines/subnets/pods/tags and deploy_failures",
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=5,
+        help="Seconds a machine spends deploying, releasing or commissioning",
+    )
+    args = parser.parse_args()
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            fixtures = json.load(f)
+    server = serve(args.port, fixtures, args.delay, verbose=True)
+    print(f"--MAAS_URL {server.url} --MAAS_API_KEY {server.api_key}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
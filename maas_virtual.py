@@ -3,6 +3,7 @@
 from maas_base import MaasBase
 from ipaddress import IPv4Network, IPv4Address
 import osias_variables
+import utils
 
 
 class MaasVirtual(MaasBase):
@@ -34,6 +35,7 @@ class MaasVirtual(MaasBase):
                     )
             self._run_maas_command(f"interface disconnect {server} eno3")
             self._set_interface(server, "eno3", osias_variables.VM_Profile["Data_CIDR"])
+        self._invalidate_machines(server_list)
 
     def _get_pod_id(self, storage, cores, memory, num_VMs):
         pods = self._run_maas_command("pods read")
@@ -72,9 +74,9 @@ class MaasVirtual(MaasBase):
                 vms_needed,
             )
             max_vm_supported_in_pod = (
-                lambda max_vm_supported_in_pod: max_vm_supported_in_pod
-                if (max_vm_supported_in_pod >= 0)
-                else 0
+                lambda max_vm_supported_in_pod: (
+                    max_vm_supported_in_pod if (max_vm_supported_in_pod >= 0) else 0
+                )
             )(max_vm_supported_in_pod)
             print(f"Pod {pod['id']}, can support {max_vm_supported_in_pod} VM's.")
             pods_needed.extend([pod["id"]] * int(max_vm_supported_in_pod))
@@ -116,7 +118,8 @@ class MaasVirtual(MaasBase):
             )
             server_list.append(server["system_id"])
 
-        machine_info = self._run_maas_command("machines read")
+        self._invalidate_machines(server_list)
+        machine_info = self._inventory().records(server_list)
         self._waiting(server_list, "Ready")
         self._create_bridge_interface(
             server_list, osias_variables.VM_Profile["VM_DEPLOYMENT_CIDR"], machine_info
@@ -124,6 +127,7 @@ class MaasVirtual(MaasBase):
         self._run_maas_command(
             f"tag update-nodes openstack_ready{''.join([' add=' + sub for sub in server_list])}"
         )
+        self._invalidate_machines(server_list)
 
         return server_list
 
@@ -134,15 +138,13 @@ class MaasVirtual(MaasBase):
         release = vm_profile["OPENSTACK_RELEASE"].replace(".", "_")
         distro_hwe = osias_variables.MAAS_VM_DISTRO[vm_profile["OPENSTACK_RELEASE"]]
         distro = distro_hwe.split(" ")[0]
-        machines = self._run_maas_command(
-            "machines read | jq '.[] | {system_id:.system_id,status_name:.status_name,pool_name:.pool.name,ip_addresses:.ip_addresses,distro_series:.distro_series,tag_names:.tag_names}' --compact-output"
-        )
+        machines = self._inventory().records()
         ids = []
         machine_no = 0
         for machine in machines:
             if (
                 machine["status_name"] == "Deployed"
-                and machine["pool_name"] == "virtual_machine_pool"
+                and machine["pool"]["name"] == "virtual_machine_pool"
                 and machine["distro_series"] == distro
                 and machine["tag_names"].__contains__("openstack_ready")
                 and machine_no < no_of_vms
@@ -169,14 +171,13 @@ class MaasVirtual(MaasBase):
             for tag in tags:
                 self._run_maas_command(f"tag update-nodes {tag} add={vm}")
             self._run_maas_command(f"tag update-nodes openstack_ready remove={vm}")
+        self._invalidate_machines(ids)
         return ids
 
     def find_virtual_machines_and_deploy(self, vm_profile, pipeline_id: int):
         release = vm_profile["OPENSTACK_RELEASE"].replace(".", "_")
         pipeline_tag_name = f"{pipeline_id}_{release}"
-        machines = self._run_maas_command(
-            "machines read | jq '.[] | {system_id:.system_id,status_name:.status_name,pool_name:.pool.name,ip_addresses:.ip_addresses,distro_series:.distro_series,tag_names:.tag_names}' --compact-output"
-        )
+        machines = self._inventory().records()
         ids = []
         vip = ""
         ip_start = ""
@@ -206,9 +207,8 @@ class MaasVirtual(MaasBase):
             filters = (
                 f"{parent_project_pipeline_id}_{openstack_release.replace('.', '_')}"
             )
-        defs = self._run_maas_command(
-            f"machines read |jq '.[] | {{system_id:.system_id,tag_names:.tag_names}} | select(.tag_names| contains([\"{filters}\"]))'"
-        )
+        inventory = self._inventory()
+        defs = inventory.records(inventory.with_tag_containing(filters))
         vips = []
         starts = []
         machine_ids = []
@@ -217,36 +217,35 @@ class MaasVirtual(MaasBase):
             distro = osias_variables.MAAS_VM_DISTRO[openstack_release]
         else:
             distro = None
-        if isinstance(defs, dict):
-            defs = [defs]
-        if defs:
-            for i in defs:
-                machine_ids.append(i["system_id"])
-                vips.append([s for s in i["tag_names"] if "vip" in s][0])
-                starts.append([s for s in i["tag_names"] if "start" in s][0])
-                vips = list(dict.fromkeys(vips))
-                starts = list(dict.fromkeys(starts))
-                tags = tags + i["tag_names"]
-            if len(vips) > 0:
-                vips = [s.replace("_", ".").split("-")[1] for s in vips]
-            if len(starts) > 0:
-                starts = [s.replace("_", ".").split("-")[1] for s in starts]
-            ips = vips + starts
-            tags = [*set(tags)]
-            for tag in tags:
-                self._run_maas_command(f"tag delete {tag}")
-            for ip in ips:
-                self._run_maas_command(f"ipaddresses release ip={ip} force=true")
+        for i in defs:
+            machine_ids.append(i["system_id"])
+            vips.append([s for s in i["tag_names"] if "vip" in s][0])
+            starts.append([s for s in i["tag_names"] if "start" in s][0])
+            vips = list(dict.fromkeys(vips))
+            starts = list(dict.fromkeys(starts))
+            tags = tags + i["tag_names"]
+        if len(vips) > 0:
+            vips = [s.replace("_", ".").split("-")[1] for s in vips]
+        if len(starts) > 0:
+            starts = [s.replace("_", ".").split("-")[1] for s in starts]
+        ips = vips + starts
+        tags = [*set(tags)]
+        for tag in tags:
+            self._run_maas_command(f"tag delete {tag}")
+        self._invalidate_machines(machine_ids)
+        for ip in ips:
+            self._run_maas_command(f"ipaddresses release ip={ip} force=true")
         return machine_ids, distro
 
     def delete_virtual_machines(self, machine_ids: list, distro: str):
-        for machine_id in machine_ids:
-            self._run_maas_command(f"machine release {machine_id}")
-            self._run_maas_command(f"tag update-nodes openstack_ready add={machine_id}")
-            self._waiting([f"{machine_id}"], "Ready")
-            self._run_maas_command(
-                f"machine deploy {machine_id} distro_series={distro}"
-            )
+        if not machine_ids:
+            return
+        submissions = self._submit("release", machine_ids)
+        self._run_maas_command(
+            f"tag update-nodes openstack_ready{''.join([' add=' + sub for sub in machine_ids])}"
+        )
+        self._waiting(machine_ids, "Ready", submissions)
+        self._submit("deploy", machine_ids, utils.FAIL_AT_END, distro=distro)
 
     def get_machines_interface_ip(
         self, server_list, machines_info, interface, interface_common_name
@@ -0,0 +1,126 @@
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cassette
+
+# Seconds a host that answered over SSH is considered ready without probing.
+KNOWN_READY_TTL = 60
+# Overall time allowed for hosts to become reachable, per wait_for_ssh call.
+DEADLINE = 600
+MAX_WORKERS = 32
+
+_known_ready = {}
+_lock = threading.Lock()
+
+
+def is_known_ready(host):
+    with _lock:
+        ready_at = _known_ready.get(host)
+    return ready_at is not None and time.monotonic() - ready_at < KNOWN_READY_TTL
+
+
+def mark_ready(host):
+    with _lock:
+        _known_ready[host] = time.monotonic()
+
+
+def forget(hosts=None):
+    """Drop the known-ready status of the hosts, or of every host.
+
+    Call this whenever a host is about to go away, e.g. before a reboot."""
+    with _lock:
+        if hosts is None:
+            _known_ready.clear()
+        for host in hosts or []:
+            _known_ready.pop(host, None)
+
+
+def _tcp_connect(host, port, timeout):
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def tcp_reachable(host, port=22, timeout=3):
+    """Cheap check that something accepts connections on the SSH port."""
+    return cassette.call(
+        "tcp", host, str(port), lambda: _tcp_connect(host, port, timeout)
+    )
+
+
+def backoff_delays(base=2, cap=30):
+    """Jittered exponential backoff: base, 2*base, 4*base... up to cap."""
+    attempt = 0
+    while True:
+        delay = min(cap, base * 2**attempt)
+        yield random.uniform(delay / 2, delay)
+        attempt += 1
+
+
+class Probe:
+    """Progress of waiting for one host to answer over SSH.
+
+    Shared by the threaded and the asyncio probes, which only do the TCP
+    check, the ssh and the sleep themselves."""
+
+    def __init__(self, client, deadline):
+        self.client = client
+        self.host = client.ip
+        self.deadline = deadline
+        self.delays = backoff_delays()
+
+    def known_ready(self):
+        return is_known_ready(self.host)
+
+    def succeeded(self):
+        mark_ready(self.host)
+        # A master that failed while the host was booting may work now.
+        self.client.forget_master_failure()
+        print(f"Successfully connected to {self.host}")
+        return True
+
+    def next_delay(self):
+        """Seconds to wait before the next attempt, None once out of time."""
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            print(f"Failed to connect to {self.host}, giving up.")
+            return None
+        delay = min(next(self.delays), remaining)
+        print(f"Failed to connect to {self.host}, Retry in {delay:.0f} seconds")
+        return delay
+
+
+def _probe(client, deadline):
+    probe = Probe(client, deadline)
+    while True:
+        if probe.known_ready():
+            return True
+        if (
+            tcp_reachable(probe.host)
+            and client.ssh("uname -a", test=False, silent=True) == 0
+        ):
+            return probe.succeeded()
+        delay = probe.next_delay()
+        if delay is None:
+            return False
+        cassette.sleep(delay)
+
+
+def wait_for_ssh(clients, deadline=DEADLINE):
+    """Probe every ssh_tool client at once until it answers or time runs out.
+
+    Returns {ip: True/False}. Hosts already known to be ready are not probed."""
+    end = time.monotonic() + deadline
+    pending = [client for client in clients if not is_known_ready(client.ip)]
+    results = {client.ip: True for client in clients}
+    if not pending:
+        return results
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(pending))) as pool:
+        for client, ready in zip(pending, pool.map(lambda c: _probe(c, end), pending)):
+            results[client.ip] = ready
+    return results
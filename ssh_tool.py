@@ -1,23 +1,208 @@
+import atexit
+import collections
+import hashlib
+import json
+import os
+import shlex
+import shutil
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
 import time
 
+import cassette
+import instrumentation
+import readiness
+
+# Directory holding the OpenSSH ControlMaster sockets for this process.
+_CONTROL_DIR = None
+# Control sockets of the master connections opened by this process.
+_CONTROL_MASTERS = {}
+# Hosts whose master connection failed to start, they are not tried again
+# until they answered a readiness probe, see forget_master_failure.
+_FAILED_MASTERS = set()
+# One lock per host so that only one thread starts its master connection.
+_MASTER_LOCKS = {}
+_CONTROL_LOCK = threading.Lock()
+
+# Content-hash upload cache: "remote" compares against the digest of the remote
+# copy, "local" trusts the manifest of what was pushed before, "off" disables it.
+UPLOAD_CACHE_MODE = os.getenv("OSIAS_UPLOAD_CACHE", "remote")
+UPLOAD_CACHE_DIR = os.path.expanduser(
+    os.getenv("OSIAS_UPLOAD_CACHE_DIR", "~/.cache/osias/uploads")
+)
+_MANIFEST_LOCK = threading.Lock()
+
+
+def _control_dir():
+    global _CONTROL_DIR
+    with _CONTROL_LOCK:
+        if _CONTROL_DIR is None:
+            # Keep the path short, unix sockets are limited to ~108 characters.
+            _CONTROL_DIR = tempfile.mkdtemp(prefix="osias-ssh-")
+    return _CONTROL_DIR
+
+
+def _master_lock(key):
+    with _CONTROL_LOCK:
+        return _MASTER_LOCKS.setdefault(key, threading.Lock())
+
+
+def close_all_masters():
+    """Close every master connection opened by this process."""
+    for client in list(_CONTROL_MASTERS.values()):
+        client.close()
+    if _CONTROL_DIR is not None:
+        shutil.rmtree(_CONTROL_DIR, ignore_errors=True)
+
+
+atexit.register(close_all_masters)
+
+
+def write_bundle(fileobj, files):
+    """Write files and directories as a gzip compressed tar stream to fileobj."""
+    with tarfile.open(fileobj=fileobj, mode="w|gz") as tar:
+        for path in files:
+            tar.add(path, arcname=os.path.basename(os.path.normpath(path)))
+
+
+def local_size(path):
+    """Size in bytes of a file, or of all files below a directory."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class _counting_writer:
+    """File object wrapper counting the bytes written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fileobj.write(data)
+
+
+def file_digests(files):
+    """Return {local path: (name in bundle, sha256)} for the regular files.
+
+    Directories are left out and are always uploaded."""
+    digests = {}
+    for path in files:
+        if not os.path.isfile(path):
+            continue
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                sha.update(chunk)
+        digests[path] = (os.path.basename(os.path.normpath(path)), sha.hexdigest())
+    return digests
+
+
+def bundle_key(file_path_remote, files):
+    """Identifies a bundle upload in a cassette."""
+    return f"{file_path_remote}:{' '.join(files)}"
+
+
+def invalidate_upload_cache():
+    """Forget every upload recorded for every host."""
+    shutil.rmtree(UPLOAD_CACHE_DIR, ignore_errors=True)
+
 
 class ssh_tool:
-    def __init__(self, username, ip_address, sshkey=None):
+    # Seconds an idle master connection is kept open in the background.
+    CONTROL_PERSIST = 600
+    # Lines of output kept in memory for error reports when streaming.
+    TAIL_LINES = 200
+
+    def __init__(self, username, ip_address, sshkey=None, multiplex=True):
         self.rem_username = username
         self.ip = ip_address
         self.sshkey = sshkey
+        self.multiplex = multiplex and os.getenv("OSIAS_SSH_MULTIPLEX", "1") != "0"
 
-    def ssh(self, command, test=True, option=None, output=False, silent=False):
+    @property
+    def _control_path(self):
+        return os.path.join(_control_dir(), "%C")
 
+    @property
+    def _master_key(self):
+        return (self.rem_username, self.ip, self.sshkey)
+
+    def _key_options(self):
         if self.sshkey is None:
-            keyls = []
+            return []
+        return ["-i", self.sshkey]
+
+    def _common_options(self):
+        options = self._key_options() + [
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "BatchMode=yes",
+        ]
+        if self.multiplex and self._open_master():
+            # Never let a regular call become the master: a backgrounded master
+            # would inherit our stdout pipe and block check_output until it exits.
+            options.extend(
+                [
+                    "-o",
+                    "ControlMaster=no",
+                    "-o",
+                    f"ControlPath={self._control_path}",
+                ]
+            )
+        return options
+
+    def _open_master(self):
+        """Start the shared master connection for this host if not running yet.
+
+        Returns True when a master connection is available, otherwise the
+        caller falls back to a regular, non-multiplexed connection."""
+        key = self._master_key
+        if key in _CONTROL_MASTERS:
+            return True
+        if key in _FAILED_MASTERS or cassette.replaying():
+            return False
+        with _master_lock(key):
+            # Another thread may have started it, or failed, while we waited.
+            if key in _CONTROL_MASTERS:
+                return True
+            if key in _FAILED_MASTERS:
+                return False
+            with instrumentation.span("ssh_master", host=self.ip) as span:
+                ret = subprocess.call(
+                    self._master_call_list(),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                span.exit_code = ret
+            self._master_started(ret == 0)
+        return ret == 0
+
+    def _master_started(self, ok):
+        if ok:
+            print(f"{type(self).__name__}: opened master connection to {self.ip}")
+            _CONTROL_MASTERS[self._master_key] = self
         else:
-            keyls = ["-i", self.sshkey]
+            _FAILED_MASTERS.add(self._master_key)
 
-        call_list = (
-            ["ssh"]
-            + keyls
+    def forget_master_failure(self):
+        """Allow a new master connection once the host is known to answer."""
+        _FAILED_MASTERS.discard(self._master_key)
+
+    def _master_call_list(self):
+        return (
+            ["ssh", "-M", "-N", "-f"]
+            + self._key_options()
             + [
                 "-o",
                 "StrictHostKeyChecking=no",
@@ -25,31 +210,158 @@ class ssh_tool:
                 "ConnectTimeout=10",
                 "-o",
                 "BatchMode=yes",
+                "-o",
+                f"ControlPath={self._control_path}",
+                "-o",
+                f"ControlPersist={self.CONTROL_PERSIST}",
+                self.rem_username + "@" + self.ip,
             ]
         )
 
+    def close(self):
+        """Close the shared master connection for this host, if any."""
+        if _CONTROL_MASTERS.pop(self._master_key, None) is None:
+            return
+        subprocess.call(
+            ["ssh"]
+            + self._key_options()
+            + [
+                "-o",
+                f"ControlPath={self._control_path}",
+                "-O",
+                "exit",
+                self.rem_username + "@" + self.ip,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _ssh_call_list(self, command, option=None):
+        call_list = ["ssh"] + self._common_options() + ["-o", "ConnectTimeout=10"]
+
         if option:
             call_list.extend(["-o", option])
 
         call_list.extend([self.rem_username + "@" + self.ip, command])
+        return call_list
+
+    def execute(self, command, option=None):
+        """Run a command and return its exit code and combined stdout/stderr."""
+        call_list = self._ssh_call_list(command, option)
 
         print("ssh_tool: " + " ".join(call_list))
 
-        stdout = ""
-        ret = -1
-        if output or silent:
+        def run():
+            process = subprocess.run(
+                call_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            return process.returncode, process.stdout
+
+        with instrumentation.span("ssh", host=self.ip, detail=command) as span:
+            returncode, stdout = cassette.call("ssh", self.ip, command, run)
+            span.exit_code = returncode
+            span.bytes = len(stdout)
+        return returncode, stdout
+
+    def stream(self, command, option=None, log_file=None):
+        """Yield the combined stdout/stderr of a command line by line.
+
+        Only the last TAIL_LINES lines are kept, in `output_tail`, and the exit
+        code is set on `returncode` once the generator is exhausted. With
+        log_file, every line is also appended to that file."""
+        call_list = self._ssh_call_list(command, option)
+
+        print("ssh_tool: " + " ".join(call_list))
+
+        self.returncode = None
+        self.output_tail = collections.deque(maxlen=self.TAIL_LINES)
+        log = open(log_file, "ab") if log_file else None
+        # Recording keeps the whole output, to store it in the cassette.
+        recorded = [] if cassette.recording() else None
+        start = time.monotonic()
+        with instrumentation.span("ssh", host=self.ip, detail=command) as span:
+            span.bytes = 0
+            if cassette.replaying():
+                process = None
+                returncode, stdout = cassette.replay("ssh", self.ip, command)
+                lines = stdout.splitlines(keepends=True)
+            else:
+                process = subprocess.Popen(
+                    call_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                )
+                lines = process.stdout
             try:
-                stdout = subprocess.check_output(call_list, stderr=subprocess.STDOUT)
-                ret = 0
-            except subprocess.CalledProcessError as e:
-                ret = e.returncode
-                print(e)
-                print(stdout)
+                for line in lines:
+                    span.bytes += len(line)
+                    self.output_tail.append(line)
+                    if log:
+                        log.write(line)
+                    if recorded is not None:
+                        recorded.append(line)
+                    yield line
+            finally:
+                if process:
+                    process.stdout.close()
+                    returncode = process.wait()
+                self.returncode = returncode
+                span.exit_code = self.returncode
+                if log:
+                    log.close()
+                if recorded is not None:
+                    cassette.record(
+                        "ssh",
+                        self.ip,
+                        command,
+                        (returncode, b"".join(recorded)),
+                        time.monotonic() - start,
+                    )
+
+    def ssh(
+        self,
+        command,
+        test=True,
+        option=None,
+        output=False,
+        silent=False,
+        log_file=None,
+        callback=None,
+    ):
+        """Run a command on the remote host.
+
+        By default the output goes straight to our stdout. output=True returns
+        the whole output, silent=True hides it, callback is called with every
+        line and log_file receives a copy; these modes stream the output and
+        only keep a bounded tail of it for the error report."""
+        stdout = b""
+        tail = b""
+        ret = -1
+        if output or silent or log_file or callback:
+            chunks = []
+            for line in self.stream(command, option, log_file):
+                if output:
+                    chunks.append(line)
+                if callback:
+                    callback(line)
+                elif not (output or silent):
+                    sys.stdout.buffer.write(line)
+                    sys.stdout.flush()
+            ret = self.returncode
+            stdout = b"".join(chunks)
+            tail = b"".join(self.output_tail)
         else:
-            ret = subprocess.call(call_list)
+            call_list = self._ssh_call_list(command, option)
+
+            print("ssh_tool: " + " ".join(call_list))
+
+            with instrumentation.span("ssh", host=self.ip, detail=command) as span:
+                ret, _ = cassette.call(
+                    "ssh", self.ip, command, lambda: (subprocess.call(call_list), b"")
+                )
+                span.exit_code = ret
 
         if ret != 0:
-            print(stdout)
+            print(f"ssh_tool: command failed with exit code {ret} on {self.ip}")
+            print(tail.decode(errors="replace"))
 
         # By default, it is not ok to fail
         if test:
@@ -61,38 +373,137 @@ class ssh_tool:
 
     def check_access(self):
         # Check if the machine is accessible:
-        for _ in range(30):
-            out = self.ssh("uname -a", test=False)
-            if out == 0:
-                print(f"Successfully connected to {self.ip}")
-                return True
-            print(f"Failed to connect to {self.ip}, Retry in 20 seconds")
-            time.sleep(20)
-        return False
-
-    def scp_to(self, file_path_local, file_path_remote="", test=True):
+        return readiness.wait_for_ssh([self])[self.ip]
 
-        if self.sshkey is None:
-            keyls = []
-        else:
-            keyls = ["-i", self.sshkey]
-
-        call_list = (
+    def _scp_to_call_list(self, file_path_local, file_path_remote):
+        return (
             ["scp", "-r"]
-            + keyls
+            + self._common_options()
             + [
-                "-o",
-                "StrictHostKeyChecking=no",
-                "-o",
-                "BatchMode=yes",
                 file_path_local,
                 self.rem_username + "@" + self.ip + ":" + file_path_remote,
             ]
         )
 
-        print("ssh_tool: " + " ".join(call_list))
+    def _scp_from_call_list(self, file_path_remote, file_path_local):
+        return (
+            ["scp", "-r"]
+            + self._common_options()
+            + [
+                self.rem_username + "@" + self.ip + ":" + file_path_remote,
+                file_path_local,
+            ]
+        )
+
+    @staticmethod
+    def _downloaded_size(file_path_remote, file_path_local):
+        """Size of what scp_from wrote locally, None if it cannot be found."""
+        path = file_path_local
+        if os.path.isdir(path):
+            path = os.path.join(path, os.path.basename(file_path_remote.rstrip("/")))
+        if not os.path.exists(path):
+            return None
+        return local_size(path)
+
+    def _bundle_call_list(self, file_path_remote):
+        target = shlex.quote(file_path_remote or ".")
+        return self._ssh_call_list(f"mkdir -p {target} && tar -xzmf - -C {target}")
+
+    def _manifest_path(self):
+        return os.path.join(UPLOAD_CACHE_DIR, f"{self.rem_username}@{self.ip}.json")
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record_uploads(self, file_path_remote, digests):
+        with _MANIFEST_LOCK:
+            manifest = self._load_manifest()
+            for name, digest in digests.values():
+                manifest[os.path.join(file_path_remote, name)] = digest
+            os.makedirs(UPLOAD_CACHE_DIR, exist_ok=True)
+            tmp_path = self._manifest_path() + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self._manifest_path())
+
+    def invalidate_upload_cache(self):
+        """Forget every upload recorded for this host."""
+        with _MANIFEST_LOCK:
+            if os.path.exists(self._manifest_path()):
+                os.remove(self._manifest_path())
+
+    def _remote_digest_command(self, file_path_remote, digests):
+        names = " ".join(shlex.quote(name) for name, _ in digests.values())
+        target = shlex.quote(file_path_remote or ".")
+        return f"cd {target} 2>/dev/null && sha256sum -- {names} 2>/dev/null; true"
+
+    @staticmethod
+    def _parse_remote_digests(output):
+        remote_digests = {}
+        for line in output.decode(errors="replace").splitlines():
+            digest, _, name = line.partition("  ")
+            if name:
+                remote_digests[name] = digest
+        return remote_digests
+
+    def _cached_digests(self, file_path_remote, digests):
+        """Digests of the last upload of each file, according to the manifest."""
+        manifest = self._load_manifest()
+        return {
+            name: manifest.get(os.path.join(file_path_remote, name))
+            for name, _ in digests.values()
+        }
+
+    def _skip_unchanged(self, files, digests, known_digests):
+        changed = []
+        for path in files:
+            if (
+                path in digests
+                and known_digests.get(digests[path][0]) == digests[path][1]
+            ):
+                continue
+            changed.append(path)
+        skipped = [path for path in files if path not in changed]
+        if skipped:
+            print(f"ssh_tool: {self.ip} already has unchanged {' '.join(skipped)}")
+        return changed
+
+    # The steps of put_bundle around its I/O, shared with async_ssh_tool.
+
+    def _upload_candidates(self, files, file_path_remote, cache):
+        """Return (files, digests, command whose output lists the remote digests).
+
+        The command is None when the remote copies need not be asked for."""
+        if isinstance(files, str):
+            files = [files]
+        cache = cache or UPLOAD_CACHE_MODE
+        digests = {}
+        if cache != "off":
+            digests = file_digests(files)
+        command = None
+        if digests and cache != "local":
+            command = self._remote_digest_command(file_path_remote, digests)
+        return files, digests, command
+
+    def _files_to_send(self, files, file_path_remote, digests, remote_output):
+        """The files whose content is not on the host yet."""
+        if not digests:
+            return files
+        if remote_output is None:
+            known_digests = self._cached_digests(file_path_remote, digests)
+        else:
+            known_digests = self._parse_remote_digests(remote_output)
+        return self._skip_unchanged(files, digests, known_digests)
 
-        ret = subprocess.call(call_list)
+    def _bundle_sent(self, ret, file_path_remote, files, digests, test):
+        if ret == 0 and digests:
+            self._record_uploads(
+                file_path_remote, {p: d for p, d in digests.items() if p in files}
+            )
 
         # By default, it is not ok to fail
         if test:
@@ -100,29 +511,89 @@ class ssh_tool:
 
         return ret
 
-    def scp_from(self, file_path_remote, file_path_local=".", test=True):
+    def put_bundle(self, files, file_path_remote="", test=True, cache=None):
+        """Upload files as one compressed tar stream over a single SSH channel.
 
-        if self.sshkey is None:
-            keyls = []
-        else:
-            keyls = ["-i", self.sshkey]
+        The files end up in file_path_remote (default: home directory) exactly
+        as `scp_to` would place them, but with one round trip for all of them.
+        Files whose content hash matches the remote copy are not sent again,
+        see UPLOAD_CACHE_MODE for the `cache` modes."""
+        files, digests, command = self._upload_candidates(
+            files, file_path_remote, cache
+        )
+        remote_output = None
+        if command:
+            _, remote_output = self.execute(command)
+        files = self._files_to_send(files, file_path_remote, digests, remote_output)
+        if not files:
+            return 0
+        call_list = self._bundle_call_list(file_path_remote)
 
-        call_list = (
-            ["scp", "-r"]
-            + keyls
-            + [
-                "-o",
-                "StrictHostKeyChecking=no",
-                "-o",
-                "BatchMode=yes",
-                self.rem_username + "@" + self.ip + ":" + file_path_remote,
+        print("ssh_tool: " + " ".join(call_list) + " < " + " ".join(files))
+
+        def run():
+            process = subprocess.Popen(call_list, stdin=subprocess.PIPE)
+            stdin = _counting_writer(process.stdin)
+            try:
+                write_bundle(stdin, files)
+            except BrokenPipeError:
+                # The remote side failed early, the exit code tells why.
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            span.bytes = stdin.count
+            return process.wait(), b""
+
+        with instrumentation.span("bundle", host=self.ip, detail=files[0]) as span:
+            ret, _ = cassette.call(
+                "bundle", self.ip, bundle_key(file_path_remote, files), run
+            )
+            span.exit_code = ret
+        return self._bundle_sent(ret, file_path_remote, files, digests, test)
+
+    def scp_to(self, file_path_local, file_path_remote="", test=True):
+        call_list = self._scp_to_call_list(file_path_local, file_path_remote)
+
+        print("ssh_tool: " + " ".join(call_list))
+
+        with instrumentation.span(
+            "scp_to", host=self.ip, detail=file_path_local
+        ) as span:
+            ret, _ = cassette.call(
+                "scp_to",
+                self.ip,
                 file_path_local,
-            ]
-        )
+                lambda: (subprocess.call(call_list), b""),
+            )
+            span.exit_code = ret
+            if os.path.exists(file_path_local):
+                span.bytes = local_size(file_path_local)
+
+        # By default, it is not ok to fail
+        if test:
+            assert ret == 0
+
+        return ret
+
+    def scp_from(self, file_path_remote, file_path_local=".", test=True):
+        call_list = self._scp_from_call_list(file_path_remote, file_path_local)
 
         print("ssh_tool: " + " ".join(call_list))
 
-        ret = subprocess.call(call_list)
+        with instrumentation.span(
+            "scp_from", host=self.ip, detail=file_path_remote
+        ) as span:
+            ret, _ = cassette.call(
+                "scp_from",
+                self.ip,
+                file_path_remote,
+                lambda: (subprocess.call(call_list), b""),
+            )
+            span.exit_code = ret
+            span.bytes = self._downloaded_size(file_path_remote, file_path_local)
 
         # By default, it is not ok to fail
         if test:
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+"""Time config handling on a large synthetic multinode config.
+
+Compares the current implementations against the ones they replaced, which
+are kept below only for this comparison:
+
+    python3 test/bench_config.py [--files 3000] [--hosts 1500]"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import topology  # noqa: E402
+import utils  # noqa: E402
+
+
+def old_find_paths(nested_dict, value):
+    def yielder(nested_dict, value, prepath=()):
+        for k, v in nested_dict.items():
+            path = prepath + (k,)
+            if v == value:
+                yield "/".join(("/etc", *path))
+            elif hasattr(v, "items"):
+                yield from yielder(v, value, path)
+
+    return list(yielder(nested_dict, value))
+
+
+def old_flatten_config_tree(nested_dict, orig_dict, flat=None):
+    """The find_strings walk get_kolla_configs used before flatten_config_tree."""
+    flat = {} if flat is None else flat
+    for value in nested_dict.values():
+        if isinstance(value, dict):
+            old_flatten_config_tree(value, orig_dict, flat)
+        if isinstance(value, str):
+            for path in old_find_paths(orig_dict, value):
+                flat[path] = value
+    return flat
+
+
+def synthetic_etc_tree(files):
+    """Kolla style override tree with `files` distinct files, 3 levels deep."""
+    tree = {}
+    for index in range(files):
+        service = tree.setdefault(f"service{index % 50}", {})
+        component = service.setdefault(f"component{index % 7}", {})
+        component[f"override{index}.conf"] = f"[DEFAULT]\noption{index} = {index}\n"
+    return {"kolla": {"config": tree}}
+
+
+def old_unique_servers(data):
+    """The list scan get_each_servers_ips used before topology.unique_hosts."""
+    servers = []
+    for role in topology.NODE_TYPES:
+        for node in data.get(role) or []:
+            if node["public"]:
+                servers.append(node)
+    return [node for n, node in enumerate(servers) if node not in servers[:n]]
+
+
+def synthetic_multinode(hosts):
+    """Every role lists `hosts` nodes, overlapping so each host has 2 roles."""
+    data = {}
+    for offset, role in enumerate(topology.NODE_TYPES):
+        numbers = range(offset * hosts // 2, offset * hosts // 2 + hosts)
+        data[role] = [
+            {
+                "public": f"10.0.{number // 250}.{number % 250}",
+                "private": f"10.1.{number // 250}.{number % 250}",
+                "data": "",
+            }
+            for number in numbers
+        ]
+    return data
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def report(name, old, new):
+    print(f"{name:<24} old {old * 1000:10.1f} ms   new {new * 1000:8.1f} ms")
+
+
+def bench_flatten(files):
+    tree = synthetic_etc_tree(files)
+    old, old_time = timed(old_flatten_config_tree, tree, tree)
+    new, new_time = timed(utils.flatten_config_tree, tree, "/etc")
+    assert list(old.items()) == list(new.items()), "flatten_config_tree output differs"
+    report(f"flatten {files} files", old_time, new_time)
+
+
+def bench_unique_hosts(hosts):
+    data = synthetic_multinode(hosts)
+    nodes = topology.Topology(data).nodes
+    old, old_time = timed(old_unique_servers, data)
+    new, new_time = timed(topology.unique_hosts, nodes)
+    assert old == [host.as_dict() for host in new], "unique hosts differ"
+    report(f"unique_hosts {len(nodes)} nodes", old_time, new_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=3000)
+    parser.add_argument("--hosts", type=int, default=1500, help="nodes per role")
+    args = parser.parse_args()
+    bench_flatten(args.files)
+    bench_unique_hosts(args.hosts)
+
+
+if __name__ == "__main__":
+    main()
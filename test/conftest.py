@@ -0,0 +1,48 @@
+import os
+import stat
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, not in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrumentation  # noqa: E402
+import ssh_tool  # noqa: E402
+
+
+@pytest.fixture
+def fake_command(tmp_path, monkeypatch):
+    """Install shell scripts standing in for ssh, scp... first on PATH.
+
+    fake_command(name, body) writes body as the /bin/sh script `name` and
+    returns its path. Master connections start from a clean slate and are
+    only used with multiplex=True."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(ssh_tool, "_CONTROL_MASTERS", {})
+    monkeypatch.setattr(ssh_tool, "_FAILED_MASTERS", set())
+
+    def install(name, body, multiplex=False):
+        monkeypatch.setenv("OSIAS_SSH_MULTIPLEX", "1" if multiplex else "0")
+        script = bin_dir / name
+        script.write_text("#!/bin/sh\n" + body)
+        script.chmod(script.stat().st_mode | stat.S_IXUSR)
+        return script
+
+    return install
+
+
+@pytest.fixture
+def local_ssh(fake_command):
+    """An ssh that runs the remote command locally, in the working directory."""
+    return fake_command("ssh", 'for last; do :; done\nexec sh -c "$last"\n')
+
+
+@pytest.fixture
+def trace(tmp_path, monkeypatch):
+    """Record the instrumentation spans of the test, returns events()."""
+    monkeypatch.setattr(instrumentation, "TRACE_DIR", str(tmp_path))
+    monkeypatch.setattr(instrumentation, "_events", [])
+    return instrumentation.events
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import cassette
+import maas_api
+import utils
+
+
+@pytest.fixture
+def tape(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    yield path
+    cassette.configure("")
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        b"plain text\n",
+        b"\xff\xfe binary",
+        (0, b"output"),
+        {"status": (1, [b"a", b"\x80"]), "count": 3},
+        [None, 1.5, "text"],
+    ],
+)
+def test_encode_decode_round_trip(value):
+    assert cassette._decode(cassette._encode(value)) == value
+
+
+def test_record_then_replay(tape):
+    cassette.configure("record", tape)
+    assert cassette.call("ssh", "10.0.0.1", "uname", lambda: (0, b"Linux\n")) == (
+        0,
+        b"Linux\n",
+    )
+    assert cassette.call("ssh", "10.0.0.1", "uname", lambda: (0, b"again\n")) == (
+        0,
+        b"again\n",
+    )
+    assert cassette.call("maas", None, "machines read", lambda: b"[]") == b"[]"
+
+    cassette.configure("replay", tape, speed=0)
+
+    def live():
+        raise AssertionError("replay must not run the call")
+
+    assert cassette.call("maas", None, "machines read", live) == b"[]"
+    # Calls with the same host and key come back in recorded order.
+    assert cassette.call("ssh", "10.0.0.1", "uname", live) == (0, b"Linux\n")
+    assert cassette.call("ssh", "10.0.0.1", "uname", live) == (0, b"again\n")
+    with pytest.raises(Exception, match="No more recorded ssh calls"):
+        cassette.call("ssh", "10.0.0.1", "uname", live)
+
+
+def test_recorded_failure_is_raised_on_replay(tape):
+    cassette.configure("record", tape)
+
+    def fail():
+        raise OSError("connection refused")
+
+    with pytest.raises(OSError):
+        cassette.call("maas", None, "machine deploy x", fail)
+
+    cassette.configure("replay", tape, speed=0)
+    with pytest.raises(cassette.Recorded_Failure, match="connection refused"):
+        cassette.call("maas", None, "machine deploy x", fail)
+
+
+def test_async_record_then_replay(tape):
+    async def run():
+        return 0, b"done"
+
+    cassette.configure("record", tape)
+    assert asyncio.run(cassette.call_async("bundle", "h", "key", run)) == (0, b"done")
+    cassette.configure("replay", tape, speed=0)
+    assert asyncio.run(cassette.call_async("bundle", "h", "key", None)) == (0, b"done")
+
+
+def test_replay_scales_sleeps(tape, monkeypatch):
+    slept = []
+    monkeypatch.setattr(cassette.time, "sleep", slept.append)
+    cassette.configure("replay", tape, speed=10)
+    cassette.sleep(30)
+    cassette.configure("replay", tape, speed=0)
+    cassette.sleep(30)
+    assert slept == [3.0]
+
+
+def test_cli_login_is_skipped_while_replaying(tape, monkeypatch):
+    def run_cmd(command, *args, **kwargs):
+        raise AssertionError(f"ran {command}")
+
+    monkeypatch.setattr(maas_api, "USE_CLI", True)
+    monkeypatch.setattr(utils, "run_cmd", run_cmd)
+    cassette.configure("replay", tape, speed=0)
+    assert maas_api.login("http://maas:5240/MAAS", "a:b:c") is None
@@ -0,0 +1,31 @@
+import json
+import threading
+
+import instrumentation
+
+
+def test_concurrent_spans_of_one_host_get_separate_lanes(trace, tmp_path):
+    barrier = threading.Barrier(3)
+
+    def maas_call():
+        with instrumentation.span("maas", detail="machines read"):
+            barrier.wait()
+
+    threads = [threading.Thread(target=maas_call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with instrumentation.span("ssh", host="10.0.0.1", detail="uname -a"):
+        pass
+
+    path = tmp_path / "trace.json"
+    instrumentation.export_chrome_trace(str(path))
+    trace = json.loads(path.read_text())["traceEvents"]
+    names = {e["tid"]: e["args"]["name"] for e in trace if e["ph"] == "M"}
+    slices = [e for e in trace if e["ph"] == "X"]
+    maas_lanes = {e["tid"] for e in slices if e["cat"] == "maas"}
+    assert len(maas_lanes) == 3
+    assert sorted(names[tid] for tid in maas_lanes) == ["local", "local #2", "local #3"]
+    (ssh,) = [e for e in slices if e["cat"] == "ssh"]
+    assert names[ssh["tid"]] == "10.0.0.1"
@@ -0,0 +1,50 @@
+import ipaddress
+import random
+
+import pytest
+
+import ip_pool
+
+
+def _random_allocator(rng):
+    network = ipaddress.ip_network("10.0.0.0/20")
+    base = int(network.network_address)
+    used = []
+    for _ in range(rng.randint(0, 60)):
+        start = base + rng.randint(0, network.num_addresses - 1)
+        used.append((start, start + rng.randint(0, 40)))
+    return ip_pool.IpAllocator(str(network), used)
+
+
+def _fitting_gaps(allocator, size):
+    return [(s, e) for s, e in allocator.free if e - s + 1 >= size]
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_find_matches_a_scan_of_the_gaps(seed):
+    rng = random.Random(seed)
+    allocator = _random_allocator(rng)
+    for size in (1, 2, 5, 17, 64, 300, 5000):
+        gaps = _fitting_gaps(allocator, size)
+        lowest = allocator.find(size, ip_pool.LOWEST)
+        best = allocator.find(size, ip_pool.BEST_FIT)
+        picked = allocator.find(size, ip_pool.RANDOM)
+        if not gaps:
+            assert lowest is best is picked is None
+            continue
+        assert lowest == gaps[0][0]
+        assert best == min(gaps, key=lambda gap: (gap[1] - gap[0], gap[0]))[0]
+        assert gaps[0][0] <= picked <= gaps[0][1] - size + 1
+
+
+def test_full_subnet_has_no_block():
+    allocator = ip_pool.IpAllocator("192.168.3.0/24", [(0, 2**32 - 1)])
+    assert allocator.free == []
+    assert allocator.allocate(1, ip_pool.LOWEST) is None
+
+
+def test_allocate_crosses_octet_boundaries():
+    network = int(ipaddress.ip_address("10.0.0.0"))
+    allocator = ip_pool.IpAllocator("10.0.0.0/23", [(network, network + 250)])
+    block = allocator.allocate(10, ip_pool.LOWEST)
+    assert block[0] == "10.0.0.251" and block[-1] == "10.0.1.4"
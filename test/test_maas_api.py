@@ -0,0 +1,59 @@
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import pytest
+
+import maas_api
+import maas_stub
+
+
+@pytest.fixture
+def stub():
+    server = maas_stub.serve()
+    yield server
+    server.shutdown()
+
+
+def test_timeout_does_not_poison_the_thread_connection(stub):
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(5)
+    accepted = []
+    threading.Thread(
+        target=lambda: accepted.append(silent.accept()), daemon=True
+    ).start()
+    client = maas_api.MaasClient(
+        f"http://127.0.0.1:{silent.getsockname()[1]}/MAAS", stub.api_key
+    )
+    client.TIMEOUT = 0.5
+    with pytest.raises(TimeoutError):
+        client.run("machines read")
+    client.netloc = urlsplit(stub.url).netloc
+    assert client.run("machines read")
+    silent.close()
+
+
+def test_reads_are_retried_on_a_dropped_connection_writes_are_not(stub):
+    client = maas_api.MaasClient(stub.url, stub.api_key)
+    client.run("machines read")
+    client._local.connection.sock.shutdown(socket.SHUT_RDWR)
+    assert client.run("machines read")
+    client._local.connection.sock.shutdown(socket.SHUT_RDWR)
+    with pytest.raises(OSError):
+        client.run("machine deploy stub01 distro_series=focal")
+    assert stub.state.machines["stub01"]["status_name"] == "Ready"
+    assert client.run("machines read")
+
+
+def test_stub_requests_leave_the_default_fixtures_alone(stub):
+    client = maas_api.MaasClient(stub.url, stub.api_key)
+    client.run("tag update-nodes foo add=stub01")
+    client.run("vm-host compose 1")
+    assert stub.state.machines["stub01"]["tag_names"] == ["foo"]
+    assert maas_stub.DEFAULT_FIXTURES["machines"][0]["tag_names"] == []
+    fresh = maas_stub.serve()
+    try:
+        assert fresh.state.machines["stub01"]["tag_names"] == []
+    finally:
+        fresh.shutdown()
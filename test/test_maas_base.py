@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+import cassette
+import maas_api
+import maas_base
+import maas_stub
+
+
+def _machine(system_id, ips, tags=()):
+    return {"system_id": system_id, "ip_addresses": ips, "tag_names": list(tags)}
+
+
+def test_inventory_update_with_duplicated_ip_and_tag():
+    inventory = maas_base.MachineInventory(
+        [
+            _machine("a", ["10.0.0.1", "10.0.0.1"], ["ready", "ready"]),
+            _machine("b", ["10.0.0.2"], ["ready"]),
+        ],
+        0,
+    )
+    inventory.update([_machine("a", ["10.0.0.3"])])
+    assert inventory.with_ips(["10.0.0.1"]) == []
+    assert inventory.with_ips(["10.0.0.3"]) == ["a"]
+    assert inventory.with_tag_containing("ready") == ["b"]
+
+    inventory.update([], system_ids=["b"])
+    assert inventory.by_ip == {"10.0.0.3": {"a": None}}
+    assert inventory.by_tag == {}
+
+
+@pytest.fixture
+def maas(monkeypatch):
+    """A MaasBase logged in to a fresh stub, polling without the long sleeps."""
+    servers = []
+
+    def connect(delay=0.05, deploy_failures=None):
+        fixtures = dict(maas_stub.DEFAULT_FIXTURES)
+        fixtures["deploy_failures"] = deploy_failures or {}
+        server = maas_stub.serve(fixtures=fixtures, delay=delay)
+        servers.append(server)
+        monkeypatch.setattr(
+            maas_api, "_client", maas_api.MaasClient(server.url, server.api_key)
+        )
+        monkeypatch.setattr(cassette, "sleep", lambda seconds: time.sleep(0.02))
+        maas = maas_base.MaasBase("focal")
+        maas.stub = server
+        return maas
+
+    yield connect
+    for server in servers:
+        server.shutdown()
+
+
+def test_deploy_reaches_deployed(maas):
+    client = maas()
+    client.deploy(["stub01", "stub02"])
+    for system_id in ("stub01", "stub02"):
+        machine = client.stub.state.machines[system_id]
+        assert machine["status_name"] == "Deployed"
+        assert machine["distro_series"] == "focal"
+
+
+def test_failed_deployment_is_released_and_redeployed(maas, capsys):
+    client = maas(deploy_failures={"stub01": 2})
+    client.deploy(["stub01", "stub02"])
+    assert client.stub.state.machines["stub01"]["status_name"] == "Deployed"
+    assert capsys.readouterr().out.count("STATE: Re-deploying.") == 2
+    assert client.stub.state.deploy_failures["stub01"] == 0
+
+
+def test_deploy_fails_once_the_retries_are_used_up(maas):
+    client = maas(deploy_failures={"stub01": 3})
+    with pytest.raises(maas_base.Machine_State_Failed) as failed:
+        client.deploy(["stub01", "stub02"])
+    assert failed.value.failures == {"stub01": "Failed deployment"}
+    assert client.stub.state.machines["stub02"]["status_name"] == "Deployed"
+
+
+def test_rejected_submission_fails_only_that_machine(maas):
+    client = maas()
+    with pytest.raises(maas_base.Machine_State_Failed) as failed:
+        client.deploy(["stub01", "missing"])
+    assert list(failed.value.failures) == ["missing"]
+    assert failed.value.failures["missing"].startswith("MAAS rejected the request")
+    assert client.stub.state.machines["stub01"]["status_name"] == "Deployed"
+
+
+def test_machine_fails_after_its_wait_timeout(maas):
+    client = maas(delay=60)
+    client.WAIT_TIMEOUT = 0.2
+    with pytest.raises(maas_base.Machine_State_Failed) as failed:
+        client.commission(["stub01"])
+    assert failed.value.failures == {"stub01": "did not reach Ready within 0.2 seconds"}
@@ -0,0 +1,56 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import async_ssh_tool
+import ssh_tool
+
+
+@pytest.fixture
+def fake_ssh(fake_command, tmp_path):
+    """An ssh that logs every master start and exits with $FAKE_SSH_RC."""
+    log = tmp_path / "masters.log"
+    fake_command(
+        "ssh",
+        f'[ "$1" = "-M" ] && echo "$@" >> {log} && sleep 0.2\n'
+        'exit "${FAKE_SSH_RC:-0}"\n',
+        multiplex=True,
+    )
+    return lambda: len(log.read_text().splitlines()) if log.exists() else 0
+
+
+@pytest.mark.parametrize("rc", ["0", "255"])
+def test_parallel_calls_start_one_master(fake_ssh, monkeypatch, rc):
+    monkeypatch.setenv("FAKE_SSH_RC", rc)
+    clients = [ssh_tool.ssh_tool("ubuntu", "10.0.0.1") for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda client: client._open_master(), clients))
+    assert results == [rc == "0"] * 8
+    # A failed master is not retried by later calls.
+    assert clients[0]._open_master() == (rc == "0")
+    assert fake_ssh() == 1
+
+
+@pytest.mark.parametrize("rc", ["0", "255"])
+def test_parallel_tasks_start_one_master(fake_ssh, monkeypatch, rc):
+    monkeypatch.setenv("FAKE_SSH_RC", rc)
+    clients = [async_ssh_tool.async_ssh_tool("ubuntu", "10.0.0.1") for _ in range(8)]
+
+    async def open_all():
+        await asyncio.gather(*(client._async_open_master() for client in clients))
+        await clients[0]._async_open_master()
+
+    asyncio.run(open_all())
+    assert clients[0]._open_master() == (rc == "0")
+    assert fake_ssh() == 1
+
+
+def test_failed_master_is_retried_once_the_host_answers(fake_ssh, monkeypatch):
+    client = ssh_tool.ssh_tool("ubuntu", "10.0.0.1")
+    monkeypatch.setenv("FAKE_SSH_RC", "255")
+    assert not client._open_master()
+    monkeypatch.setenv("FAKE_SSH_RC", "0")
+    client.forget_master_failure()
+    assert client._open_master()
+    assert fake_ssh() == 2
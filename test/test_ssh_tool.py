@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+import async_ssh_tool
+import instrumentation
+import readiness
+import ssh_tool
+
+
+@pytest.fixture
+def fake_scp(fake_command, trace, tmp_path):
+    """An scp that copies "user@host:/path" from a local directory."""
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    fake_command(
+        "scp",
+        "for last; do :; done\n"
+        'for arg; do case "$arg" in *@*:*) src="${arg#*:}";; esac; done\n'
+        f'cp -r "{remote}$src" "$last"\n',
+    )
+    (remote / "kolla.log").write_bytes(b"x" * 1234)
+    local = tmp_path / "local"
+    local.mkdir()
+    return local
+
+
+def test_scp_from_records_downloaded_size(fake_scp):
+    client = ssh_tool.ssh_tool("ubuntu", "10.0.0.1")
+    client.scp_from("/kolla.log", str(fake_scp))
+    client.scp_from("/kolla.log", str(fake_scp / "renamed.log"))
+    sizes = [
+        e["bytes"] for e in instrumentation.events() if e["operation"] == "scp_from"
+    ]
+    assert sizes == [1234, 1234]
+
+
+def test_async_scp_from_records_downloaded_size(fake_scp):
+    client = async_ssh_tool.async_ssh_tool("ubuntu", "10.0.0.1")
+    asyncio.run(client.ascp_from("/kolla.log", str(fake_scp)))
+    sizes = [
+        e["bytes"] for e in instrumentation.events() if e["operation"] == "scp_from"
+    ]
+    assert sizes == [1234]
+
+
+def test_async_ssh_keeps_only_a_tail_when_silent(local_ssh, trace):
+    client = async_ssh_tool.async_ssh_tool("ubuntu", "10.0.0.1")
+    command = "seq 1 5000; exit 3"
+    ret = asyncio.run(client.assh(command, test=False, silent=True))
+    assert ret == 3
+    assert len(client.output_tail) == client.TAIL_LINES
+    assert client.output_tail[-1] == b"5000\n"
+    (event,) = instrumentation.events()
+    assert event["bytes"] == sum(len(f"{i}\n") for i in range(1, 5001))
+
+
+def test_async_execute_returns_the_whole_output(local_ssh, trace):
+    client = async_ssh_tool.async_ssh_tool("ubuntu", "10.0.0.1")
+    command = "seq 1 5000; head -c 200000 /dev/zero | tr '\\0' x"
+    ret, output = asyncio.run(client.aexecute(command))
+    expected = "".join(f"{i}\n" for i in range(1, 5001)) + "x" * 200000
+    assert ret == 0
+    assert output == expected.encode()
+
+
+@pytest.mark.parametrize("tool", ["sync", "async"])
+def test_put_bundle_skips_files_the_host_already_has(
+    local_ssh, trace, tmp_path, monkeypatch, tool
+):
+    script = tmp_path / "bootstrap.sh"
+    script.write_text("echo hello\n")
+    remote = tmp_path / "home"
+    remote.mkdir()
+    monkeypatch.chdir(remote)
+    monkeypatch.setattr(ssh_tool, "UPLOAD_CACHE_DIR", str(tmp_path / "uploads"))
+    if tool == "sync":
+        client = ssh_tool.ssh_tool("ubuntu", "10.0.0.1")
+        put_bundle = client.put_bundle
+    else:
+        client = async_ssh_tool.async_ssh_tool("ubuntu", "10.0.0.1")
+
+        def put_bundle(files):
+            return asyncio.run(client.aput_bundle(files))
+
+    assert put_bundle([str(script)]) == 0
+    assert (remote / "bootstrap.sh").read_text() == "echo hello\n"
+    assert put_bundle([str(script)]) == 0
+    script.write_text("echo changed\n")
+    assert put_bundle([str(script)]) == 0
+    assert (remote / "bootstrap.sh").read_text() == "echo changed\n"
+    bundles = [e for e in instrumentation.events() if e["operation"] == "bundle"]
+    assert len(bundles) == 2
+
+
+def test_async_tool_still_works_as_a_plain_ssh_tool(local_ssh, trace):
+    client = async_ssh_tool.async_ssh_tool("ubuntu", "10.0.0.1")
+    assert client.ssh("exit 4", test=False) == 4
+    assert client.execute("echo hi") == (0, b"hi\n")
+
+
+@pytest.mark.parametrize("tool", ["sync", "async"])
+def test_check_access_retries_until_ssh_answers(
+    local_ssh, trace, tmp_path, monkeypatch, tool
+):
+    attempts = tmp_path / "attempts"
+    monkeypatch.setattr(readiness, "tcp_reachable", lambda host: True)
+    monkeypatch.setattr(readiness, "backoff_delays", lambda: iter([0.01] * 10))
+    readiness.forget(["10.0.0.9"])
+    # uname fails on the first attempt, as if sshd was still starting.
+    command = f"echo x >> {attempts}; [ $(wc -l < {attempts}) -ge 2 ]"
+    monkeypatch.setattr(
+        ssh_tool.ssh_tool, "_ssh_call_list", lambda self, c, o=None: ["ssh", command]
+    )
+    if tool == "sync":
+        ready = ssh_tool.ssh_tool("ubuntu", "10.0.0.9").check_access()
+    else:
+        client = async_ssh_tool.async_ssh_tool("ubuntu", "10.0.0.9")
+
+        async def reachable():
+            return True
+
+        monkeypatch.setattr(client, "_tcp_reachable", reachable)
+        ready = asyncio.run(client.acheck_access(deadline=5))
+    assert ready
+    assert len(attempts.read_text().splitlines()) == 2
+    assert readiness.is_known_ready("10.0.0.9")
+    readiness.forget(["10.0.0.9"])
@@ -0,0 +1,167 @@
+import json
+
+import pytest
+import yaml
+
+import osias_variables
+import topology
+import utils
+
+MULTINODE = """
+control:
+  - public: 10.0.0.1
+    private: 192.168.1.1
+    data: 172.16.0.1
+  - public: 10.0.0.2
+    private: 192.168.1.2
+    data: 172.16.0.2
+network:
+  - public: 10.0.0.1
+    private: 192.168.1.1
+    data: 172.16.0.1
+storage:
+  - public: 10.0.0.3
+    private: 192.168.1.3
+    data: ""
+compute:
+  - public: 10.0.0.2
+    private: 192.168.1.2
+    data: 172.16.0.2
+  - public: 10.0.0.3
+    private: 192.168.1.3
+    data: ""
+monitor:
+  - public: ""
+    private: ""
+    data: ""
+variables:
+  VM_CIDR: 10.0.0.0/24
+  CEPH_RELEASE: custom
+  DOCKER: true
+"""
+
+
+# What parser returned before it was backed by topology.Topology.
+
+
+def old_get_server_ips(data, node_type, ip_type):
+    return [node[ip_type] for node in data[node_type]]
+
+
+def old_get_variables(data, variable, openstack_release=None, optional=False):
+    if "variables" in data and variable in data["variables"]:
+        return str(data["variables"][variable])
+    elif getattr(osias_variables, variable, None):
+        return getattr(osias_variables, variable)[openstack_release]
+    elif optional:
+        return None
+    raise Exception(f"Unable to location, {variable}, please specify.")
+
+
+def old_get_all_ips_type(data, ip_type):
+    ips = []
+    for role in topology.NODE_TYPES:
+        ips.extend(old_get_server_ips(data, role, ip_type))
+    return list(filter(None, dict.fromkeys(ips)))
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setenv("OSIAS_CONFIG_CACHE", "0")
+    return utils.parser(MULTINODE)
+
+
+def test_server_ips_match_the_old_parser(config):
+    data = yaml.safe_load(MULTINODE)
+    for role in topology.NODE_TYPES:
+        for ip_type in topology.IP_TYPES:
+            assert config.get_server_ips(role, ip_type) == old_get_server_ips(
+                data, role, ip_type
+            )
+            assert [n.ip(ip_type) for n in config.topology.role_nodes(role)] == (
+                old_get_server_ips(data, role, ip_type)
+            )
+    for ip_type in topology.IP_TYPES:
+        assert config.get_all_ips_type(ip_type) == old_get_all_ips_type(data, ip_type)
+
+
+def test_variables_match_the_old_parser(config):
+    data = yaml.safe_load(MULTINODE)
+    for variable in ("VM_CIDR", "CEPH_RELEASE", "DOCKER", "PYTHON_VERSION"):
+        assert config.get_variables(variable, "yoga") == old_get_variables(
+            data, variable, "yoga"
+        )
+    assert config.get_variables("MISSING", "yoga", optional=True) is None
+    with pytest.raises(Exception, match="MISSING"):
+        config.get_variables("MISSING", "yoga")
+    resolved = config.topology.resolved_variables("yoga")
+    assert resolved["PYTHON_VERSION"] == osias_variables.PYTHON_VERSION["yoga"]
+    assert resolved["DOCKER"] == "True"
+    assert config.topology.resolved_variables(None) == {
+        "VM_CIDR": "10.0.0.0/24",
+        "CEPH_RELEASE": "custom",
+        "DOCKER": "True",
+    }
+
+
+def test_hosts_are_unique_across_roles(config):
+    hosts = config.topology.hosts
+    assert [host.public for host in hosts] == ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+    assert hosts[0].roles == ("control", "network")
+    assert config.get_each_servers_ips()[2] == {
+        "public": "10.0.0.3",
+        "private": "192.168.1.3",
+        "data": "",
+    }
+
+
+VM_IPS = {
+    f"vm{index}": {
+        "public": f"10.0.0.{index}",
+        "internal": f"192.168.1.{index}",
+        "data": f"172.16.0.{index}",
+    }
+    for index in range(1, 5)
+}
+
+
+def test_multinode_dump_parse_round_trip(monkeypatch):
+    monkeypatch.setenv("OSIAS_CONFIG_CACHE", "0")
+    multinode = utils.create_multinode(VM_IPS, "DOCKER: true\nVM_CIDR: 10.0.0.0/28")
+    artifact = utils.dump_multinode(multinode)
+    assert json.loads(artifact)[utils.MULTINODE_VERSION_KEY] == (
+        utils.MULTINODE_FORMAT_VERSION
+    )
+    assert utils._parse_config(artifact) == multinode
+    # The artifact is also valid YAML for hand-edited pipelines.
+    assert {
+        k: v
+        for k, v in yaml.safe_load(artifact).items()
+        if k != utils.MULTINODE_VERSION_KEY
+    } == multinode
+    config = utils.parser(artifact)
+    assert config.get_server_ips("control", "private") == [
+        "192.168.1.1",
+        "192.168.1.2",
+        "192.168.1.3",
+    ]
+    assert config.get_server_ips("monitor", "public") == ["10.0.0.1"]
+    assert config.get_variables("DOCKER") == "True"
+
+
+def test_newer_multinode_artifact_is_refused():
+    artifact = json.loads(utils.dump_multinode(utils.create_multinode(VM_IPS, {})))
+    artifact[utils.MULTINODE_VERSION_KEY] = utils.MULTINODE_FORMAT_VERSION + 1
+    with pytest.raises(Exception, match="newer than the supported version"):
+        utils._parse_config(json.dumps(artifact))
+
+
+def test_invalid_multinode_is_not_dumped():
+    multinode = utils.create_multinode(VM_IPS, {})
+    multinode["compute"][0]["public"] = ["10.0.0.1"]
+    with pytest.raises(Exception, match="must be a string"):
+        utils.dump_multinode(multinode)
+    multinode = utils.create_multinode(VM_IPS, {})
+    multinode["variables"] = {"nested": {"a": 1}}
+    with pytest.raises(Exception, match="must be a scalar"):
+        utils.dump_multinode(multinode)
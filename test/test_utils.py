@@ -0,0 +1,80 @@
+import socket
+import time
+
+import pytest
+
+import utils
+
+
+def test_sweep_falls_back_to_tcp_within_the_deadline(monkeypatch):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    monkeypatch.setattr(utils, "SWEEP_TCP_PORTS", (listener.getsockname()[1],))
+    budgets = []
+
+    def lost_ping(ip, timeout):
+        # No answer, after using all of the time it was given.
+        budgets.append(timeout)
+        time.sleep(timeout)
+        return None
+
+    monkeypatch.setattr(utils, "_icmp_probe", lost_ping)
+    start = time.monotonic()
+    results = utils.sweep_ips(["127.0.0.1"], deadline=2)
+    listener.close()
+    assert results["127.0.0.1"]["state"] == "up"
+    assert results["127.0.0.1"]["method"] == "tcp"
+    assert budgets and budgets[0] <= 1
+    assert time.monotonic() - start < 2
+
+
+class _FakeClient:
+    def __init__(self, returncode, output):
+        self.result = (returncode, output)
+
+    def execute(self, command):
+        return self.result
+
+
+def test_private_ip_sweep_reports_states(monkeypatch):
+    client = _FakeClient(0, b"10.1.0.5 up 0.42\n10.1.0.6 down\n")
+    monkeypatch.setattr(utils, "create_ssh_client", lambda ip: client)
+    result = utils.check_private_ip_active("10.0.0.1", ["10.1.0.5", "10.1.0.6"])
+    assert result["active"] == ["10.1.0.5"]
+    assert result["inactive"] == ["10.1.0.6"]
+    assert result["rtt"] == {"10.1.0.5": 0.42}
+
+
+def test_private_ip_sweep_fails_when_the_hop_fails(monkeypatch):
+    client = _FakeClient(255, b"ssh: connect to host 10.0.0.1 port 22: No route\n")
+    monkeypatch.setattr(utils, "create_ssh_client", lambda ip: client)
+    with pytest.raises(Exception, match="exit code 255"):
+        utils.check_private_ip_active("10.0.0.1", ["10.1.0.5"])
+
+
+def test_flatten_config_tree_keeps_file_order():
+    tree = {"a": {"x": "1"}, "b": "2", "c": {"y": "3", "z": {"w": "4"}}, "d": 5}
+    flat = utils.flatten_config_tree(tree, "/etc")
+    assert list(flat.items()) == [
+        ("/etc/a/x", "1"),
+        ("/etc/b", "2"),
+        ("/etc/c/y", "3"),
+        ("/etc/c/z/w", "4"),
+    ]
+
+
+def test_tcp_probe_counts_a_refused_connection_as_up():
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    assert utils._tcp_probe("127.0.0.1", 1, ports=(port,)) is not None
+
+
+def test_tcp_probe_reports_an_unanswered_address_down(monkeypatch):
+    def create_connection(address, timeout):
+        raise socket.timeout("timed out")
+
+    monkeypatch.setattr(utils.socket, "create_connection", create_connection)
+    assert utils._tcp_probe("192.0.2.1", 0.3, ports=(22, 80)) is None
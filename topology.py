@@ -0,0 +1,153 @@
+import osias_variables
+
+NODE_TYPES = ("control", "network", "storage", "compute", "monitor")
+IP_TYPES = ("public", "private", "data")
+
+
+def _normalize(ip):
+    return str(ip).strip() if ip else ""
+
+
+class _Frozen:
+    """Base for the immutable records, attributes are only set in __init__."""
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+class Node(_Frozen):
+    """One entry of a role in the multinode file."""
+
+    __slots__ = ("role", "public", "private", "data")
+
+    def __init__(self, role, public="", private="", data=""):
+        object.__setattr__(self, "role", role)
+        object.__setattr__(self, "public", _normalize(public))
+        object.__setattr__(self, "private", _normalize(private))
+        object.__setattr__(self, "data", _normalize(data))
+
+    def ip(self, ip_type):
+        return getattr(self, ip_type)
+
+    @property
+    def key(self):
+        """Canonical identity of the machine behind this entry."""
+        return (self.public, self.private, self.data)
+
+    def __repr__(self):
+        return f"Node({self.role!r}, public={self.public!r}, private={self.private!r}, data={self.data!r})"
+
+
+class Host(_Frozen):
+    """A physical or virtual machine, with every role it is listed under."""
+
+    __slots__ = ("public", "private", "data", "roles")
+
+    def __init__(self, key, roles):
+        public, private, data = key
+        object.__setattr__(self, "public", public)
+        object.__setattr__(self, "private", private)
+        object.__setattr__(self, "data", data)
+        object.__setattr__(self, "roles", tuple(roles))
+
+    def ip(self, ip_type):
+        return getattr(self, ip_type)
+
+    @property
+    def key(self):
+        return (self.public, self.private, self.data)
+
+    def as_dict(self):
+        return {"public": self.public, "private": self.private, "data": self.data}
+
+    def __repr__(self):
+        return f"Host(public={self.public!r}, private={self.private!r}, data={self.data!r}, roles={self.roles!r})"
+
+
+def unique_hosts(nodes):
+    """De-duplicate nodes across roles in one pass, keyed on their IP tuple.
+
+    Entries without any IP are dropped; hosts keep first-seen order."""
+    roles = {}
+    for node in nodes:
+        if node.key == ("", "", ""):
+            continue
+        roles.setdefault(node.key, []).append(node.role)
+    return tuple(Host(key, host_roles) for key, host_roles in roles.items())
+
+
+class Topology(_Frozen):
+    """Read-only, indexed view of a parsed multinode config.
+
+    Every role -> IP list is computed once when the topology is built, so the
+    lookups done by deploy.py do not walk the node lists again."""
+
+    __slots__ = (
+        "nodes",
+        "hosts",
+        "variables",
+        "_role_nodes",
+        "_role_ips",
+        "_all_ips",
+        "_resolved",
+    )
+
+    def __init__(self, data):
+        nodes = []
+        role_nodes = {}
+        for role in NODE_TYPES:
+            entries = data.get(role) or []
+            role_nodes[role] = tuple(
+                Node(role, **{ip_type: entry.get(ip_type) for ip_type in IP_TYPES})
+                for entry in entries
+            )
+            nodes.extend(role_nodes[role])
+        role_ips = {
+            (role, ip_type): tuple(node.ip(ip_type) for node in role_nodes[role])
+            for role in NODE_TYPES
+            for ip_type in IP_TYPES
+        }
+        hosts = unique_hosts(nodes)
+        all_ips = {ip_type: {} for ip_type in IP_TYPES}
+        for host in hosts:
+            for ip_type in IP_TYPES:
+                if host.ip(ip_type):
+                    all_ips[ip_type][host.ip(ip_type)] = None
+        object.__setattr__(self, "nodes", tuple(nodes))
+        object.__setattr__(self, "hosts", hosts)
+        object.__setattr__(
+            self,
+            "variables",
+            {k: str(v) for k, v in (data.get("variables") or {}).items()},
+        )
+        object.__setattr__(self, "_role_nodes", role_nodes)
+        object.__setattr__(self, "_role_ips", role_ips)
+        object.__setattr__(self, "_all_ips", {k: tuple(v) for k, v in all_ips.items()})
+        object.__setattr__(self, "_resolved", {})
+
+    def role_nodes(self, role):
+        return self._role_nodes[role]
+
+    def server_ips(self, role, ip_type):
+        """IPs of one type for one role, in file order, blanks included."""
+        return self._role_ips[(role, ip_type)]
+
+    def all_ips(self, ip_type):
+        """Unique, non-empty IPs of one type across every host."""
+        return self._all_ips[ip_type]
+
+    def resolved_variables(self, openstack_release=None):
+        """Multinode variables layered over the release defaults of osias_variables.
+
+        Resolved once per release and cached."""
+        if openstack_release not in self._resolved:
+            resolved = {}
+            if openstack_release is not None:
+                for name, value in vars(osias_variables).items():
+                    if isinstance(value, dict) and openstack_release in value:
+                        resolved[name] = value[openstack_release]
+            resolved.update(self.variables)
+            self._resolved[openstack_release] = resolved
+        return self._resolved[openstack_release]
@@ -1,102 +1,170 @@
 #!/usr/bin/python3
 
+import asyncio
+import hashlib
+import json
 import os
+import re
+import selectors
+import shlex
+import socket
 import sys
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from ipaddress import IPv4Network
 from itertools import islice
 from pathlib import Path
 
 import yaml
 
-import osias_variables
+import cassette
+import instrumentation
+import readiness
+import topology
+from async_ssh_tool import async_ssh_tool
 from ssh_tool import ssh_tool
 
+try:
+    # libyaml is several times faster than the pure python loader.
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+# Parsed multinode configs are cached by content hash so that every pipeline
+# stage after the first skips parsing; set OSIAS_CONFIG_CACHE=0 to disable.
+CONFIG_CACHE_DIR = os.path.expanduser(
+    os.getenv("OSIAS_CONFIG_CACHE_DIR", "~/.cache/osias/config")
+)
+CONFIG_CACHE_VERSION = 2
+
+
+def _code_fingerprint():
+    # Any change to the parsing or topology code gets a fresh cache entry.
+    digest = hashlib.sha256(str(CONFIG_CACHE_VERSION).encode())
+    for path in (__file__, topology.__file__):
+        try:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+    return digest.hexdigest()[:16]
+
+
+CONFIG_CACHE_FINGERPRINT = _code_fingerprint()
+
+# Version of the MULTINODE.env artifact written by dump_multinode.
+MULTINODE_FORMAT_VERSION = 1
+MULTINODE_VERSION_KEY = "osias_multinode_version"
+
+
+def _parse_config(config):
+    # Artifacts written by dump_multinode are JSON, which json loads far
+    # faster than yaml; anything else is a hand written multinode file.
+    if config.lstrip().startswith("{"):
+        try:
+            data = json.loads(config)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            version = data.pop(MULTINODE_VERSION_KEY, None)
+            if version is not None and version > MULTINODE_FORMAT_VERSION:
+                raise Exception(
+                    f"ERROR: MULTINODE artifact version {version} is newer than the supported version {MULTINODE_FORMAT_VERSION}."
+                )
+            return data
+    return yaml.load(config, Loader=YamlLoader)
+
+
+def load_config(config):
+    """Return the parsed data and topology of a multinode config string."""
+    use_cache = os.getenv("OSIAS_CONFIG_CACHE", "1") != "0"
+    digest = hashlib.sha256(config.encode()).hexdigest()
+    cache_path = os.path.join(
+        CONFIG_CACHE_DIR, f"{digest}-{CONFIG_CACHE_FINGERPRINT}.json"
+    )
+    if use_cache:
+        try:
+            with open(cache_path, "r") as f:
+                data = json.load(f)
+            return data, topology.Topology(data)
+        except Exception:
+            # Missing, unreadable or not what this code expects, parse again.
+            pass
+    data = _parse_config(config)
+    config_topology = topology.Topology(data)
+    if use_cache:
+        try:
+            cached = json.dumps(data)
+            # Only cache configs that come back from JSON unchanged, yaml
+            # dates or integer keys would not.
+            if json.loads(cached) == data:
+                os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(cached)
+                os.replace(tmp_path, cache_path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"WARNING: Unable to cache the parsed config: {e}")
+    return data, config_topology
+
 
 class parser:
     def __init__(self, config):
-        self.data = yaml.safe_load(config)
+        self.data, self.topology = load_config(config)
         self.kolla_configs = {}
 
     def get_server_ips(self, node_type, ip_type):
-        data = self.data[node_type]
-        ips = []
-        for myips in data:
-            ips.append(myips[ip_type])
-        return ips
+        return list(self.topology.server_ips(node_type, ip_type))
 
     def get_variables(self, variable, openstack_release=None, optional=False):
-        if "variables" in self.data and variable in self.data["variables"]:
-            data = self.data["variables"]
-            if variable in data:
-                return str(data[variable])
-        elif getattr(osias_variables, variable, None):
-            x = getattr(osias_variables, variable)
-            return x[openstack_release]
+        variables = self.topology.resolved_variables(openstack_release)
+        if variable in variables:
+            return variables[variable]
         elif optional:
             return None
         raise Exception(f"Unable to location, {variable}, please specify.")
 
     def get_kolla_configs(self):
         if "etc" in self.data:
-            data = self.data["etc"]
-            results = {}
-            results = self.find_strings(data, data)
-            return results
+            self.kolla_configs = flatten_config_tree(self.data["etc"], "/etc")
+            return self.kolla_configs
         return None
 
-    def find_paths(self, nested_dict, value, prepath=()):
-        def yielder(nested_dict, value, prepath=()):
-            for k, v in nested_dict.items():
-                path = prepath + (k,)
-                if v == value:  # found value
-                    path = ("/etc", *path)
-                    dest = "/".join(path)
-                    yield dest
-                elif hasattr(v, "items"):  # v is a dict
-                    yield from yielder(v, value, path)
-
-        return list(yielder(nested_dict, value, prepath=()))
-
-    def find_strings(self, nested_dict, orig_dict):
-        for key, value in nested_dict.items():
-            if isinstance(value, dict):
-                self.find_strings(value, orig_dict)
-            if isinstance(value, str):
-                x = *self.find_paths(orig_dict, value), value
-                for i in range(len(x)):
-                    if i != len(x) - 1:
-                        self.kolla_configs[x[i]] = x[len(x) - 1]
-        return self.kolla_configs
-
     def get_all_ips_type(self, iptype):
-        data = ["control", "network", "storage", "compute", "monitor"]
-        ALL_IPS = []
-        for my_node_type in data:
-            ips = parser.get_server_ips(self, node_type=my_node_type, ip_type=iptype)
-            ALL_IPS.extend(ips)
-        ALL_IPS = list((dict.fromkeys(ALL_IPS)))  # remove duplicates from list
-        ALL_IPS = list(filter(None, ALL_IPS))  # remove null values from list
+        ALL_IPS = list(self.topology.all_ips(iptype))
 
         if not ALL_IPS and iptype != "data":
             raise Exception(f"{iptype} IPs are not set, empty list.")
         return ALL_IPS
 
     def get_each_servers_ips(self):
-        data = self.data.keys()
-        SERVERS = []
-        for my_node_type in data:
-            data = self.data.get(my_node_type)
-            for key, value in data.items():
-                if value["public"]:  # Remove any empty servers
-                    SERVERS.extend([value])
-                    # Remove duplicate servers from the list
-        SERVERS = [i for n, i in enumerate(SERVERS) if i not in SERVERS[:n]]
-        return SERVERS
+        """One {public, private, data} dict per unique server with a public IP."""
+        return [host.as_dict() for host in self.topology.hosts if host.public]
 
     def bool_check_ips_exist(self, node_type, ip_type):
-        data = self.data[node_type]
-        for item in data:
-            return bool(item[ip_type])
+        for node in self.topology.role_nodes(node_type):
+            return bool(node.ip(ip_type))
+
+
+def flatten_config_tree(tree, root):
+    """Map every string leaf of a nested dict to its path, in a single pass.
+
+    {"kolla": {"globals.yml": "..."}} with root "/etc" gives
+    {"/etc/kolla/globals.yml": "..."}; non-string leaves are ignored."""
+    flat = {}
+    stack = [(root, tree)]
+    while stack:
+        path, node = stack.pop()
+        if isinstance(node, str):
+            flat[path] = node
+        elif isinstance(node, dict):
+            # Pushed in reverse so entries, leaves and sub-trees alike, are
+            # popped in file order.
+            entries = [(f"{path}/{key}", value) for key, value in node.items()]
+            stack.extend(reversed(entries))
+    return flat
 
 
 def convert_to_list(parm):
@@ -122,85 +190,504 @@ def create_ssh_client(target_node):
     return client
 
 
-def copy_file_on_server(script, servers):
+def wait_for_servers(servers):
+    """Probe all servers at once and raise if any of them is unreachable."""
+    servers = convert_to_list(servers)
+    results = readiness.wait_for_ssh([ssh_tool("ubuntu", server) for server in servers])
+    unreachable = [server for server, ready in results.items() if not ready]
+    if unreachable:
+        raise Exception(
+            f"ERROR: Failed to connect to target nodes with IPs {unreachable} using SSH"
+        )
+
+
+# Fan-out failure policies, see `fan_out`.
+FAIL_FAST = "fail_fast"
+FAIL_AT_END = "fail_at_end"
+QUORUM = "quorum"
+
+
+class HostResult:
+    """Outcome of one remote operation on one host."""
+
+    def __init__(self, host, returncode, elapsed, output=b"", error=None):
+        self.host = host
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.output = output
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and self.error is None
+
+    def __repr__(self):
+        return f"HostResult(host={self.host!r}, returncode={self.returncode}, elapsed={self.elapsed:.1f}s)"
+
+
+class FanOutResult:
+    """Per-host results of an operation fanned out over several servers."""
+
+    def __init__(self, results=None):
+        self.results = results or {}
+
+    @property
+    def succeeded(self):
+        return [r for r in self.results.values() if r.ok]
+
+    @property
+    def failed(self):
+        return [r for r in self.results.values() if not r.ok]
+
+    def summary(self):
+        lines = []
+        for host, result in self.results.items():
+            state = (
+                "OK" if result.ok else f"FAILED ({result.error or result.returncode})"
+            )
+            lines.append(f"\t{host}: {state} in {result.elapsed:.1f}s")
+        return "\n".join(lines)
+
+
+class Remote_Execution_Failed(Exception):
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+def _run_on_host(host, operation):
+    start = time.monotonic()
+    try:
+        returncode, output = operation(host)
+        return HostResult(host, returncode, time.monotonic() - start, output)
+    except Exception as e:
+        return HostResult(host, -1, time.monotonic() - start, error=e)
+
+
+def fan_out(
+    operation, servers, policy=FAIL_AT_END, max_workers=8, tolerated_failures=0
+):
+    """Run `operation(host)` on all servers at once using a bounded thread pool.
+
+    `operation` returns a (returncode, output) tuple. With FAIL_FAST the first
+    failure cancels hosts that have not started yet, FAIL_AT_END waits for every
+    host, and QUORUM only fails when more than `tolerated_failures` hosts failed.
+    """
+    if policy not in (FAIL_FAST, FAIL_AT_END, QUORUM):
+        raise Exception(f"ERROR: Unknown fan-out policy, {policy}.")
     servers = convert_to_list(servers)
+    result = FanOutResult()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(servers)))) as pool:
+        futures = {pool.submit(_run_on_host, host, operation): host for host in servers}
+        for future in as_completed(futures):
+            host_result = future.result()
+            result.results[host_result.host] = host_result
+            print(f"\n----- {host_result.host} ({host_result.elapsed:.1f}s) -----")
+            if host_result.output:
+                print(host_result.output.decode(errors="replace"))
+            if not host_result.ok and policy == FAIL_FAST:
+                for pending in futures:
+                    pending.cancel()
+                break
+    print(f"\nFan-out results:\n{result.summary()}\n")
+
+    allowed = tolerated_failures if policy == QUORUM else 0
+    if len(result.failed) > allowed:
+        raise Remote_Execution_Failed(
+            f"ERROR: {len(result.failed)} of {len(servers)} servers failed:\n{result.summary()}",
+            result,
+        )
+    return result
+
+
+def _script_command(script, args=None):
+    if args:
+        arguments = ""
+        for arg in args:
+            arguments += "".join((' "', arg, '"'))
+        return "".join((script, arguments))
+    return script
+
+
+def _script_log_file(script, server):
+    """Log file for a script's output when OSIAS_LOG_DIR is set, else None."""
+    log_dir = os.getenv("OSIAS_LOG_DIR")
+    if not log_dir:
+        return None
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, f"{server}-{Path(script).stem}.log")
+
+
+_print_lock = threading.Lock()
+
+
+def host_printer(host):
+    """Callback printing the output lines of a host, each prefixed with it.
+
+    Used when several hosts run at once, so their output stays readable."""
+    prefix = f"[{host}] "
+
+    def print_line(line):
+        text = line.decode(errors="replace")
+        if not text.endswith("\n"):
+            text += "\n"
+        with _print_lock:
+            sys.stdout.write(prefix + text)
+            sys.stdout.flush()
+
+    return print_line
+
+
+def copy_file_on_server(files, servers, parallel=False, policy=FAIL_AT_END):
+    """Copy one or more files to the servers in a single bundle per server."""
+    servers = convert_to_list(servers)
+    files = convert_to_list(files)
+    wait_for_servers(servers)
+    if parallel:
+
+        def operation(server):
+            client = create_ssh_client(server)
+            return client.put_bundle(files, test=False), b""
+
+        return fan_out(operation, servers, policy)
     for server in servers:
         client = create_ssh_client(server)
-        client.scp_to(script)
+        client.put_bundle(files)
 
 
-def run_script_on_server(script, servers, args=None):
+def run_script_on_server(
+    script, servers, args=None, files=None, parallel=False, policy=FAIL_AT_END
+):
+    """Upload the script, along with any extra files it needs, then source it."""
     servers = convert_to_list(servers)
+    bundle = [script] + convert_to_list(files or [])
+    cmd = _script_command(script, args)
+    wait_for_servers(servers)
+    if parallel:
+
+        def operation(server):
+            client = create_ssh_client(server)
+            ret = client.put_bundle(bundle, test=False)
+            if ret != 0:
+                return ret, b""
+            ret = client.ssh(
+                "".join(("source ", cmd)),
+                test=False,
+                log_file=_script_log_file(script, server),
+                callback=host_printer(server),
+            )
+            # Already printed while it ran.
+            return ret, b""
+
+        return fan_out(operation, servers, policy)
     for server in servers:
         client = create_ssh_client(server)
-        client.scp_to(script)
-        if args:
-            arguments = ""
-            for arg in args:
-                arguments += "".join((' "', arg, '"'))
-            cmd = "".join((script, arguments))
-        else:
-            cmd = script
+        client.put_bundle(bundle)
 
         print(cmd)
-        client.ssh("".join(("source ", cmd)))
+        client.ssh("".join(("source ", cmd)), log_file=_script_log_file(script, server))
 
 
-def run_cmd_on_server(cmd, servers):
+def run_cmd_on_server(cmd, servers, parallel=False, policy=FAIL_AT_END):
     servers = convert_to_list(servers)
+    wait_for_servers(servers)
+    if parallel:
+
+        def operation(server):
+            client = create_ssh_client(server)
+            return client.ssh(cmd, test=False, callback=host_printer(server)), b""
+
+        return fan_out(operation, servers, policy)
     for server in servers:
         client = create_ssh_client(server)
         client.ssh(cmd)
 
 
+async def create_async_ssh_client(target_node):
+    client = async_ssh_tool("ubuntu", target_node)
+    if not await client.acheck_access():
+        raise Exception(
+            f"ERROR: Failed to connect to target node with IP {target_node} using SSH"
+        )
+    return client
+
+
+async def run_script_on_server_async(script, servers, args=None, files=None):
+    """Awaitable run_script_on_server, running on all servers concurrently.
+
+    The number of simultaneous SSH sessions is capped by the session semaphore
+    in async_ssh_tool. Every server runs to completion before failures are
+    raised as Remote_Execution_Failed."""
+    servers = convert_to_list(servers)
+    bundle = [script] + convert_to_list(files or [])
+    cmd = _script_command(script, args)
+
+    async def run(server):
+        start = time.monotonic()
+        try:
+            client = await create_async_ssh_client(server)
+            await client.aput_bundle(bundle)
+            returncode = await client.assh(
+                "".join(("source ", cmd)),
+                test=False,
+                log_file=_script_log_file(script, server),
+                callback=host_printer(server),
+            )
+            host_result = HostResult(server, returncode, time.monotonic() - start)
+        except Exception as e:
+            host_result = HostResult(server, -1, time.monotonic() - start, error=e)
+        print(f"\n----- {server} ({host_result.elapsed:.1f}s) -----")
+        if host_result.output:
+            print(host_result.output.decode(errors="replace"))
+        return host_result
+
+    host_results = await asyncio.gather(*(run(server) for server in servers))
+    result = FanOutResult({r.host: r for r in host_results})
+    if result.failed:
+        raise Remote_Execution_Failed(
+            f"ERROR: {len(result.failed)} of {len(servers)} servers failed running {script}:\n{result.summary()}",
+            result,
+        )
+    return result
+
+
 def run_cmd(command, test=True, output=True):
     print(f"\nCommand Issued: \n\t{command}\n")
     stdout = None
-    try:
-        stdout = subprocess.check_output(
-            command, stderr=subprocess.STDOUT, shell=True, executable="/bin/bash"
-        )
-    except subprocess.CalledProcessError as e:
-        if test:
-            raise Exception(e.output.decode()) from e
-        print(e.output.decode())
+    with instrumentation.span("run_cmd", detail=command) as span:
+        try:
+            stdout = subprocess.check_output(
+                command, stderr=subprocess.STDOUT, shell=True, executable="/bin/bash"
+            )
+            span.exit_code = 0
+            span.bytes = len(stdout)
+        except subprocess.CalledProcessError as e:
+            span.exit_code = e.returncode
+            if test:
+                raise Exception(e.output.decode()) from e
+            print(e.output.decode())
     if output:
         print(f"\nCommand Output: \n{stdout.decode()}\n")
     return stdout
 
 
-def run_cmd_locally(command, test=True, output=True):
+def run_cmd_locally(command, test=True, output=True, timeout=None):
+    """Run a local command, echoing its stdout/stderr as it is produced.
+
+    Output is copied in chunks as soon as it is available. Returns the exit
+    code, raises if it is non-zero and test is set, and kills the command if
+    it runs longer than timeout seconds."""
     print(f"\nCommand Issued: \n\t{command}\n")
-    stdout = None
-    process = subprocess.Popen(command, stdout=subprocess.PIPE)
-    for c in iter(lambda: process.stdout.read(1), b""):
-        sys.stdout.buffer.write(c)
+    deadline = time.monotonic() + timeout if timeout else None
+    with instrumentation.span("run_cmd_locally", detail=command) as span:
+        span.bytes = 0
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        fd = process.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                remaining = None
+                if deadline:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        process.kill()
+                        process.wait()
+                        raise Exception(
+                            f"ERROR: {command} did not finish within {timeout} seconds."
+                        )
+                if not selector.select(remaining):
+                    continue
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                span.bytes += len(chunk)
+                if output:
+                    sys.stdout.buffer.write(chunk)
+                    sys.stdout.flush()
+        process.stdout.close()
+        ret = process.wait()
+        span.exit_code = ret
+    if ret != 0:
+        message = f"ERROR: {command} exited with code {ret}."
+        if test:
+            raise Exception(message)
+        print(message)
+    return ret
 
 
-def check_ip_active(ip):
-    response = os.system("ping -c 1 " + ip + " > /dev/null 2>&1")
-    if response == 0:
-        print(f"Ping shows {ip} is in use (packets received)!")
-        return True
-    else:
-        print(f"Ping shows {ip} is NOT in use (packets lost)!")
+# Ports tried, in order, when an address does not answer ICMP echo requests.
+SWEEP_TCP_PORTS = (22, 443, 80)
+
+
+def _expand_targets(targets):
+    """Accept an IP, a CIDR or a list of either and return the list of IPs."""
+    if isinstance(targets, str):
+        if "/" in targets:
+            return [str(ip) for ip in IPv4Network(targets, strict=False).hosts()]
+        return [targets]
+    ips = []
+    for target in targets:
+        ips.extend(_expand_targets(target))
+    return ips
+
+
+def _icmp_probe(ip, timeout):
+    """Return the RTT in ms, None when lost, or False when ping is unusable."""
+    try:
+        process = subprocess.run(
+            ["ping", "-c", "1", "-W", str(max(1, int(timeout))), ip],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    except OSError:
         return False
+    if process.returncode == 0:
+        match = re.search(rb"time[=<]([0-9.]+)", process.stdout)
+        return float(match.group(1)) if match else 0.0
+    if process.returncode == 1:
+        return None
+    # Any other exit code, e.g. no permission to open an ICMP socket.
+    return False
 
 
-def check_private_ip_active(public_ip: str, private_ips: list):
-    result = dict()
-    result["active"] = []
-    result["inactive"] = []
-    for private_ip in private_ips:
+def _tcp_probe(ip, timeout, ports=None):
+    """Return the connect time in ms if the host answers on any port, else None.
+
+    A refused connection is an answer too, only a host that is there can
+    reset it. timeout is shared by all ports."""
+    end = time.monotonic() + timeout
+    for port in ports or SWEEP_TCP_PORTS:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        start = time.perf_counter()
         try:
-            run_cmd_on_server(
-                "ping -c 1 " + private_ip + " > /dev/null 2>&1", public_ip
+            with socket.create_connection((ip, port), timeout=remaining):
+                pass
+        except ConnectionRefusedError:
+            pass
+        except OSError:
+            # Timed out, or the address is unreachable.
+            continue
+        return (time.perf_counter() - start) * 1000
+    return None
+
+
+def _probe_ip(ip, end, method):
+    return cassette.call("probe", ip, method, lambda: _probe_ip_live(ip, end, method))
+
+
+def _probe_ip_live(ip, end, method):
+    """Probe ip before the time.monotonic() deadline end."""
+    if method in ("auto", "icmp"):
+        budget = end - time.monotonic()
+        if method == "auto":
+            # Leave the other half of the time to the TCP fallback.
+            budget /= 2
+        rtt = _icmp_probe(ip, budget) if budget > 0 else None
+        if rtt is not None and rtt is not False:
+            return {"state": "up", "rtt": rtt, "method": "icmp"}
+        if method == "icmp" and rtt is None:
+            return {"state": "down", "rtt": None, "method": "icmp"}
+    rtt = _tcp_probe(ip, end - time.monotonic())
+    if rtt is not None:
+        return {"state": "up", "rtt": rtt, "method": "tcp"}
+    return {"state": "down", "rtt": None, "method": "tcp"}
+
+
+def sweep_ips(targets, deadline=5, method="auto", max_workers=64):
+    """Probe every address at once and return {ip: {"state", "rtt", "method"}}.
+
+    targets is an IP, a CIDR or a list of either. Each address is pinged and,
+    with method="auto", falls back to a TCP connect when ICMP gets no answer
+    within half of the deadline or cannot be used; method="tcp" only
+    connects. Addresses that have not answered when the overall deadline
+    (seconds) expires are reported down."""
+    ips = list(dict.fromkeys(_expand_targets(targets)))
+    results = {ip: {"state": "down", "rtt": None, "method": None} for ip in ips}
+    if not ips:
+        return results
+    end = time.monotonic() + deadline
+    pool = ThreadPoolExecutor(max_workers=min(max_workers, len(ips)))
+    futures = {pool.submit(_probe_ip, ip, end, method): ip for ip in ips}
+    done, _ = wait(futures, timeout=deadline)
+    for future in done:
+        results[futures[future]] = future.result()
+    # Do not wait on probes still running past the deadline.
+    pool.shutdown(wait=False)
+    return results
+
+
+def check_ip_active(ip):
+    return check_ips_active([ip])[ip]
+
+
+def check_ips_active(ips, deadline=5):
+    """Sweep the addresses at once and return {ip: True if it is in use}."""
+    active = {}
+    for ip, result in sweep_ips(ips, deadline).items():
+        active[ip] = result["state"] == "up"
+        if active[ip]:
+            print(
+                f"Ping shows {ip} is in use ({result['method']} answered in {result['rtt']:.1f} ms)!"
             )
-            print(f"INFO: Ping shows {private_ip} is in use (packets received)!")
-            result["active"].append(private_ip)
-        except:
-            print(f"INFO: Ping shows {private_ip} is NOT in use (packets lost)!")
-            result["inactive"].append(private_ip)
+        else:
+            print(f"Ping shows {ip} is NOT in use (packets lost)!")
+    return active
+
+
+# Pings every address given as argument in parallel, one "<ip> up <rtt>" or
+# "<ip> down" line per address.
+PING_SWEEP_SCRIPT = (
+    'for ip in "$@"; do ('
+    'if out=$(ping -c 1 -W 2 "$ip" 2>/dev/null); then '
+    'echo "$ip up $(echo "$out" | sed -n "s/.*time=\\([0-9.]*\\).*/\\1/p")"; '
+    'else echo "$ip down"; fi) & done; wait'
+)
+
+
+def parse_ping_sweep(output, ips):
+    """Turn ping sweep output into {"active": [...], "inactive": [...], "rtt": {ip: ms}}."""
+    result = {"active": [], "inactive": [], "rtt": {}}
+    states = {}
+    for line in output.decode(errors="replace").splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[1] in ("up", "down"):
+            states[fields[0]] = fields
+    for ip in ips:
+        fields = states.get(ip)
+        if fields and fields[1] == "up":
+            result["active"].append(ip)
+            result["rtt"][ip] = float(fields[2]) if len(fields) > 2 else None
+        else:
+            result["inactive"].append(ip)
+    return result
+
+
+def check_private_ip_active(public_ip: str, private_ips: list):
+    """Ping all private IPs at once from public_ip over a single SSH session."""
+    client = create_ssh_client(public_ip)
+    quoted_ips = " ".join(shlex.quote(ip) for ip in private_ips)
+    returncode, output = client.execute(
+        f"bash -c {shlex.quote(PING_SWEEP_SCRIPT)} ping_sweep {quoted_ips}"
+    )
+    if returncode != 0:
+        # Without this every address would look free when the hop itself fails.
+        raise Exception(
+            f"ERROR: Ping sweep from {public_ip} failed with exit code {returncode}: {output.decode(errors='replace').strip()}"
+        )
+    result = parse_ping_sweep(output, private_ips)
+    for private_ip in result["active"]:
+        print(
+            f"INFO: Ping shows {private_ip} is in use (packets received, {result['rtt'][private_ip]} ms)!"
+        )
+    for private_ip in result["inactive"]:
+        print(f"INFO: Ping shows {private_ip} is NOT in use (packets lost)!")
     return result
 
 
@@ -218,48 +705,69 @@ def create_kolla_config_files(data: dict):
             f.write("__EOF__\n")
 
 
+def _multinode_entry(ips):
+    return {
+        "public": ips["public"],
+        "private": ips["internal"],
+        "data": ips.get("data", ""),
+    }
+
+
 def create_multinode(input_dictionary, optional_variables):
-    control_items = list(islice(input_dictionary.items(), 3))
-    monitor_item = list(islice(input_dictionary.items(), 1))
-    control_labels = ["control", "network"]
-    secondary_labels = ["storage", "compute"]
-    monitor_label = ["monitor"]
+    """Build the multinode dict for MaaS created VMs.
+
+    input_dictionary maps system IDs to their public/internal/data IPs and
+    optional_variables becomes the variables section."""
+    control_items = list(islice(input_dictionary.values(), 3))
+    monitor_item = list(islice(input_dictionary.values(), 1))
+    all_items = list(input_dictionary.values())
     multinode = {}
-    for label in control_labels:
-        multinode[label] = []
-        for i, value in enumerate(control_items):
-            multinode[label].append(i)
-            multinode[label][i] = {}
-            multinode[label][i]["public"] = value[1]["public"]
-            multinode[label][i]["private"] = value[1]["internal"]
-            multinode[label][i]["data"] = value[1]["data"]
-    for label in secondary_labels:
-        multinode[label] = []
-        for i, (k, v) in enumerate(input_dictionary.items()):
-            multinode[label].append(i)
-            multinode[label][i] = {}
-            multinode[label][i]["public"] = v["public"]
-            multinode[label][i]["private"] = v["internal"]
-            multinode[label][i]["data"] = v["data"]
-    for label in monitor_label:
-        multinode[label] = []
-        for i, (k, v) in enumerate(monitor_item):
-            multinode[label].append(i)
-            multinode[label][i] = {}
-            multinode[label][i]["public"] = v["public"]
-            multinode[label][i]["private"] = v["internal"]
-            multinode[label][i]["data"] = v["data"]
-    multinode["variables"] = {}
-    optional_variables = dict(
-        [
-            (x.split(":")[0].strip(), x.split(":")[1].strip("' "))
-            for x in optional_variables.strip("{}").split(",")
-        ]
-    )
-    multinode["variables"].update(optional_variables)
+    for label in ["control", "network"]:
+        multinode[label] = [_multinode_entry(v) for v in control_items]
+    for label in ["storage", "compute"]:
+        multinode[label] = [_multinode_entry(v) for v in all_items]
+    multinode["monitor"] = [_multinode_entry(v) for v in monitor_item]
+    if isinstance(optional_variables, str):
+        optional_variables = yaml.safe_load(optional_variables) or {}
+    multinode["variables"] = dict(optional_variables)
     return multinode
 
 
+def validate_multinode(multinode):
+    """Check a multinode dict against the artifact schema, raise if it is invalid."""
+    for role in topology.NODE_TYPES:
+        nodes = multinode.get(role)
+        if not isinstance(nodes, list):
+            raise Exception(f"ERROR: Multinode section <{role}> must be a list.")
+        for node in nodes:
+            if not isinstance(node, dict):
+                raise Exception(f"ERROR: Multinode <{role}> entry {node} is not a map.")
+            for ip_type in topology.IP_TYPES:
+                if not isinstance(node.get(ip_type, ""), (str, type(None))):
+                    raise Exception(
+                        f"ERROR: Multinode <{role}> {ip_type} IP must be a string, got {node.get(ip_type)!r}."
+                    )
+    variables = multinode.get("variables", {})
+    if not isinstance(variables, dict):
+        raise Exception("ERROR: Multinode section <variables> must be a map.")
+    for name, value in variables.items():
+        if not isinstance(value, (str, int, float, bool, type(None))):
+            raise Exception(
+                f"ERROR: Multinode variable <{name}> must be a scalar, got {value!r}."
+            )
+
+
+def dump_multinode(multinode):
+    """Serialize a multinode dict to the versioned MULTINODE.env artifact.
+
+    The artifact is canonical JSON, which is also valid YAML, so it can be
+    passed to --config as is. It is validated here, once, when written."""
+    validate_multinode(multinode)
+    artifact = {MULTINODE_VERSION_KEY: MULTINODE_FORMAT_VERSION}
+    artifact.update(multinode)
+    return json.dumps(artifact, sort_keys=True, separators=(",", ":"))
+
+
 def create_new_ssh_key():
     cleanup_cmd = "rm -f deploy_id_rsa"
     run_cmd(cleanup_cmd)